@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import json
+import logging
+from decimal import Decimal
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import websockets
+from solders.pubkey import Pubkey
+
+import settings
+
+# called with the token balance of the account, or with None after a reconnect, when notifications may have been
+# missed and the balance has to be checked another way
+BalanceCallback = Callable[[Optional[Decimal]], Awaitable[None]]
+
+
+def _token_amount(value: Optional[dict]) -> Decimal:
+    """Token balance from a jsonParsed account, zero for an account which doesn't exist or was closed."""
+    try:
+        return Decimal(value['data']['parsed']['info']['tokenAmount']['uiAmountString'])
+    except (KeyError, TypeError):
+        return Decimal(0)
+
+
+class _Connection:
+    """One websocket with the subscriptions of up to `capacity` accounts. Reconnects and subscribes again when the
+    connection drops."""
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, url: str, commitment: str, capacity: int,
+                 on_balance: Callable[[str, Optional[Decimal]], None]):
+        self._url = url
+        self._commitment = commitment
+        self.capacity = capacity
+        self._on_balance = on_balance
+        # account -> subscription id, None until the subscription is confirmed
+        self.accounts: Dict[str, Optional[int]] = {}
+        self._subscriptions: Dict[int, str] = {}
+        # request id -> (method, account)
+        self._requests: Dict[int, Tuple[str, str]] = {}
+        self._request_ids = itertools.count(1)
+        self._ws = None
+        self._task = asyncio.create_task(self._run())
+
+    async def subscribe(self, account: str) -> None:
+        self.accounts[account] = None
+        if self._ws is not None:
+            await self._request('accountSubscribe', account,
+                                [account, {'encoding': 'jsonParsed', 'commitment': self._commitment}])
+
+    async def unsubscribe(self, account: str) -> None:
+        subscription = self.accounts.pop(account, None)
+        if subscription is None:
+            # not confirmed yet, it is dropped when the confirmation comes
+            return
+        self._subscriptions.pop(subscription, None)
+        if self._ws is not None:
+            await self._request('accountUnsubscribe', account, [subscription])
+
+    async def _request(self, method: str, account: str, params: List) -> None:
+        request_id = next(self._request_ids)
+        self._requests[request_id] = (method, account)
+        try:
+            await self._ws.send(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}))
+        except websockets.ConnectionClosed:
+            # everything is subscribed again on reconnect
+            self._requests.pop(request_id, None)
+
+    async def _run(self) -> None:
+        delay = 1
+        reconnect = False
+        while True:
+            try:
+                async with websockets.connect(self._url, ping_interval=20) as ws:
+                    self._ws = ws
+                    self._subscriptions.clear()
+                    self._requests.clear()
+                    for account in list(self.accounts):
+                        self.accounts[account] = None
+                        await self.subscribe(account)
+                        if reconnect:
+                            self._on_balance(account, None)
+                    delay = 1
+                    async for message in ws:
+                        self._handle(json.loads(message))
+            except (OSError, websockets.WebSocketException) as e:
+                self._logger.warning('Websocket %s failed: %s, reconnecting in %ds', self._url, e, delay)
+            except Exception:
+                # e.g. an unexpected message, dropping the connection is better than stopping to watch its accounts
+                self._logger.exception('Websocket %s failed, reconnecting in %ds', self._url, delay)
+            self._ws = None
+            reconnect = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def _handle(self, message: dict) -> None:
+        if 'id' in message:
+            method, account = self._requests.pop(message['id'], (None, None))
+            if 'error' in message:
+                self._logger.error('%s for %s failed: %s', method, account, message['error'])
+            elif method == 'accountSubscribe':
+                subscription = message['result']
+                if account in self.accounts:
+                    self.accounts[account] = subscription
+                    self._subscriptions[subscription] = account
+                else:
+                    # unsubscribed while the subscription was being confirmed
+                    asyncio.create_task(self._request('accountUnsubscribe', account, [subscription]))
+        elif message.get('method') == 'accountNotification':
+            params = message['params']
+            account = self._subscriptions.get(params['subscription'])
+            if account is not None:
+                self._on_balance(account, _token_amount(params['result']['value']))
+
+    async def close(self) -> None:
+        self._task.cancel()
+        if self._ws is not None:
+            await self._ws.close()
+
+
+class TokenAccountSubscriptions:
+    """
+    Notifies about balance changes of token accounts with `accountSubscribe`, instead of polling them.
+
+    Accounts are multiplexed over as few websocket connections as possible, at most `per_connection` accounts on
+    each. An account doesn't have to exist yet, the first notification comes when it is created.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, url: str = settings.SOLANA_WS_URL,
+                 per_connection: int = settings.SOLANA_WS_SUBSCRIPTIONS_PER_CONNECTION,
+                 commitment: str = 'confirmed'):
+        self._url = url
+        self._per_connection = per_connection
+        self._commitment = commitment
+        self._connections: List[_Connection] = []
+        self._callbacks: Dict[str, Tuple[_Connection, BalanceCallback]] = {}
+
+    async def subscribe(self, account: Pubkey, callback: BalanceCallback) -> None:
+        account = str(account)
+        if account in self._callbacks:
+            connection, _ = self._callbacks[account]
+            self._callbacks[account] = (connection, callback)
+            return
+        connection = min((c for c in self._connections if len(c.accounts) < c.capacity),
+                         key=lambda c: len(c.accounts), default=None)
+        if connection is None:
+            connection = _Connection(self._url, self._commitment, self._per_connection, self._on_balance)
+            self._connections.append(connection)
+        self._callbacks[account] = (connection, callback)
+        await connection.subscribe(account)
+
+    async def unsubscribe(self, account: Pubkey) -> None:
+        connection, _ = self._callbacks.pop(str(account), (None, None))
+        if connection is not None:
+            await connection.unsubscribe(str(account))
+
+    def __contains__(self, account: Pubkey) -> bool:
+        return str(account) in self._callbacks
+
+    def _on_balance(self, account: str, balance: Optional[Decimal]) -> None:
+        if account in self._callbacks:
+            _, callback = self._callbacks[account]
+            asyncio.create_task(self._notify(account, callback, balance))
+
+    async def _notify(self, account: str, callback: BalanceCallback, balance: Optional[Decimal]) -> None:
+        try:
+            await callback(balance)
+        except Exception:
+            self._logger.exception('Balance callback for %s failed', account)
+
+    async def close(self) -> None:
+        for connection in self._connections:
+            await connection.close()
+        self._connections = []
+        self._callbacks = {}
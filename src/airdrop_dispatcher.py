@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+from solders.pubkey import Pubkey
+
+import settings
+from crypto import Crypto, Drop
+from transaction_planner import SentTransaction
+
+
+class AirdropDispatcher:
+    """
+    Collects drops requested within `window` seconds and sends them together, so that a wave of claims costs
+    a few packed transactions instead of one transaction per claim.
+
+    A batch is sent when the window passes or when it reaches `max_batch` drops. Each caller gets the transaction
+    carrying its own drop, or an error if it was never submitted. A drop to a receiver already in the batch waits for the next one,
+    so that its token account isn't created twice.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, crypto: Crypto, window: float = settings.AIRDROP_BATCH_WINDOW,
+                 max_batch: int = settings.AIRDROP_MAX_BATCH):
+        self._crypto = crypto
+        self._window = window
+        self._max_batch = max_batch
+        self._pending: List[Tuple[Drop, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def drop(self, receiver: str, token_amount: Decimal, sol_amount: Decimal) -> SentTransaction:
+        """Queues a drop and returns its transaction once it is submitted. A failed submission is reported in
+        `error` of the transaction instead of raised, since the transaction may still land."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((Drop(Pubkey.from_string(receiver), token_amount, sol_amount), future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = []
+        deferred = []
+        receivers = set()
+        for drop, future in self._pending:
+            if future.done():
+                # the request was cancelled while waiting
+                continue
+            if drop.receiver in receivers or len(batch) >= self._max_batch:
+                deferred.append((drop, future))
+            else:
+                receivers.add(drop.receiver)
+                batch.append((drop, future))
+        self._pending = deferred
+        if deferred:
+            self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[Drop, asyncio.Future]]) -> None:
+        try:
+            results = await self._crypto.transfer_drops([drop for drop, _ in batch])
+        except Exception as e:
+            self._logger.exception('Failed to send a batch of %d drops', len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (drop, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
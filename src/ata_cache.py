@@ -0,0 +1,41 @@
+import json
+import logging
+import os
+from typing import Iterable, Set
+
+from solders.pubkey import Pubkey
+
+
+class AtaCache:
+    """
+    Associated token accounts which are known to exist, persisted to a JSON file.
+
+    Token accounts are practically never closed, so once an account was seen on chain it is not checked again.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, path: str):
+        self._path = path
+        self._addresses: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._addresses = set(json.load(f))
+            self._logger.info('Loaded %d known token accounts from %s', len(self._addresses), path)
+
+    def __contains__(self, address: Pubkey) -> bool:
+        return str(address) in self._addresses
+
+    def add_many(self, addresses: Iterable[Pubkey]) -> None:
+        new_addresses = {str(address) for address in addresses} - self._addresses
+        if not new_addresses:
+            return
+        self._addresses |= new_addresses
+        # per process, so that bots sharing the file don't write into the same temp file
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(sorted(self._addresses), f)
+            os.replace(tmp_path, self._path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
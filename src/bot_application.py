@@ -0,0 +1,60 @@
+import asyncio
+from typing import Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+# limit of the semaphore Application takes before process_update, the real limit is applied in process_update
+UNLIMITED_UPDATES = 2 ** 31
+
+
+def _get_serialization_key(update: object) -> Optional[Hashable]:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatSerialApplication(Application):
+    """
+    Application that processes updates concurrently (bounded by `concurrent_updates`) but never runs two updates
+    of the same chat at once, so ConversationHandler states stay consistent.
+
+    An update first waits for its chat and only then takes one of the `concurrent_updates` slots, so a chat with
+    a backlog of updates holds at most one slot and doesn't block the other chats.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # private attributes of python-telegram-bot 20.1-20.3, pinned in pyproject.toml; later versions moved them
+        # to BaseUpdateProcessor, where overriding them would quietly do nothing
+        if not hasattr(self, '_concurrent_updates_sem') or not hasattr(self, '_concurrent_updates'):
+            raise RuntimeError('ChatSerialApplication needs python-telegram-bot 20.1-20.3')
+        # Application takes a slot before process_update is called, waiting for a chat would hold it; its limit is
+        # lifted and the slots are taken here instead, inside the chat lock
+        self._update_slots = asyncio.BoundedSemaphore(self._concurrent_updates or 1)
+        self._concurrent_updates_sem = asyncio.BoundedSemaphore(UNLIMITED_UPDATES)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_lock_users: Dict[Hashable, int] = {}
+
+    async def process_update(self, update: object) -> None:
+        key = _get_serialization_key(update)
+        if key is None:
+            async with self._update_slots:
+                await super().process_update(update)
+            return
+
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        self._chat_lock_users[key] = self._chat_lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._update_slots:
+                    await super().process_update(update)
+        finally:
+            self._chat_lock_users[key] -= 1
+            if not self._chat_lock_users[key]:
+                del self._chat_lock_users[key]
+                del self._chat_locks[key]
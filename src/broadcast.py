@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+
+import settings
+from user_controller import UserController
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `capacity` stored."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def pause(self, seconds: float) -> None:
+        # used on 429: nobody gets a token until `seconds` have passed
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class BroadcastJob:
+    chat_id: int
+    method: str
+    kwargs: Dict[str, Any]
+    attempts: int = 0
+
+
+@dataclass
+class BroadcastStats:
+    enqueued: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retried: int = 0
+    _sent_at: Deque[float] = field(default_factory=lambda: deque(maxlen=1000))
+
+
+class Broadcaster:
+    """
+    Background fan-out of bot messages to many chats.
+
+    Jobs are queued with `enqueue` and sent by a pool of workers, so the handler that produced them returns
+    immediately. Sending respects both Telegram's global limit (~30 msg/s per bot) and the per-chat limit
+    (~1 msg/s), backs off on 429 and unsubscribes users who blocked the bot.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, user_controller: UserController,
+                 workers: int = settings.BROADCAST_WORKERS,
+                 global_rate: float = settings.BROADCAST_GLOBAL_RATE,
+                 per_chat_rate: float = settings.BROADCAST_PER_CHAT_RATE,
+                 max_attempts: int = 3):
+        self._user_controller = user_controller
+        self._workers_count = workers
+        self._per_chat_rate = per_chat_rate
+        self._max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+        self.stats = BroadcastStats()
+
+    def start(self, bot: Bot) -> None:
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+        self._logger.info('Started broadcaster with %d workers', self._workers_count)
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._logger.info('Stopped broadcaster, %s', self.get_stats())
+
+    def enqueue(self, chat_ids: List[int], method: str, **kwargs) -> None:
+        for chat_id in chat_ids:
+            self._queue.put_nowait(BroadcastJob(chat_id=chat_id, method=method, kwargs=kwargs))
+        self.stats.enqueued += len(chat_ids)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def throughput(self, window: float = 60) -> float:
+        now = time.monotonic()
+        return sum(1 for t in self.stats._sent_at if now - t <= window) / window
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'enqueued': self.stats.enqueued,
+            'sent': self.stats.sent,
+            'failed': self.stats.failed,
+            'blocked': self.stats.blocked,
+            'retried': self.stats.retried,
+            'queue_depth': self.queue_depth(),
+            'msgs_per_sec': round(self.throughput(), 2),
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # forget chats which are idle long enough to have a full bucket again
+                self._chat_buckets = {k: v for k, v in self._chat_buckets.items() if not v.is_full()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._per_chat_rate, 1)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._send(job)
+            except Exception:
+                self._logger.exception('Unexpected error while broadcasting to %s', job.chat_id)
+            finally:
+                self._queue.task_done()
+                if self._queue.empty():
+                    self._logger.info('Broadcast queue drained, %s', self.get_stats())
+
+    async def _send(self, job: BroadcastJob) -> None:
+        await self._chat_bucket(job.chat_id).acquire()
+        await self._global_bucket.acquire()
+        job.attempts += 1
+        try:
+            await getattr(self._bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            self._logger.warning('Flood control hit, pausing broadcast for %s seconds', e.retry_after)
+            self._global_bucket.pause(e.retry_after)
+            self._retry(job)
+        except Forbidden:
+            self._logger.info('User %s blocked the bot, unsubscribing', job.chat_id)
+            self.stats.blocked += 1
+            await self._user_controller.update_mapping_request_subscription(job.chat_id, False)
+        except BadRequest as e:
+            self._logger.warning('Failed to broadcast to %s: %s', job.chat_id, e)
+            self.stats.failed += 1
+        except (TimedOut, NetworkError):
+            self._retry(job)
+        else:
+            self.stats.sent += 1
+            self.stats._sent_at.append(time.monotonic())
+
+    def _retry(self, job: BroadcastJob) -> None:
+        if job.attempts >= self._max_attempts:
+            self._logger.warning('Giving up broadcasting to %s after %d attempts', job.chat_id, job.attempts)
+            self.stats.failed += 1
+            return
+        self.stats.retried += 1
+        self._queue.put_nowait(job)
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+
+import settings
+from crypto import Crypto
+from drop_user_controller import DropUserController
+
+
+class ClaimReconciler:
+    """
+    Resolves pending airdrop claims by the status of their transactions: a claim whose transaction landed is
+    finalised, one whose transaction failed, or can't land anymore because its blockhash expired, is rolled back.
+
+    A claim without a transaction is left alone, it is still being sent or the process sending it died between
+    submitting the transaction and recording it; the latter has to be resolved by hand.
+
+    Every `totals_interval` seconds the claim counters are recomputed as well, repairing any drift.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, controller: DropUserController, crypto: Crypto,
+                 interval: float = settings.CLAIM_RECONCILE_INTERVAL,
+                 totals_interval: float = settings.CLAIM_TOTALS_RECONCILE_INTERVAL):
+        self._controller = controller
+        self._crypto = crypto
+        self._interval = interval
+        self._totals_interval = totals_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def reconcile(self) -> Tuple[int, int]:
+        """Returns how many claims were finalised and rolled back."""
+        claims = [claim for claim in await self._controller.get_pending_claims() if claim.signature]
+        if not claims:
+            return 0, 0
+        statuses = await self._crypto.get_transaction_statuses([claim.signature for claim in claims])
+        block_height = None
+        finalized = rolled_back = 0
+        for claim, status in zip(claims, statuses):
+            if status is None:
+                if claim.last_valid_block_height is None:
+                    continue
+                if block_height is None:
+                    block_height = await self._crypto.get_block_height()
+                if block_height <= claim.last_valid_block_height:
+                    continue
+                # the status is checked after the height, so a transaction landing in between isn't missed
+                if (await self._crypto.get_transaction_statuses([claim.signature]))[0] is not None:
+                    continue
+                self._logger.warning('Transaction %s of claim %s expired, rolling back', claim.signature, claim.id)
+                await self._controller.rollback_claim(claim)
+                rolled_back += 1
+            elif status:
+                await self._controller.finalize_claim(claim)
+                finalized += 1
+            else:
+                self._logger.warning('Transaction %s of claim %s failed, rolling back', claim.signature, claim.id)
+                await self._controller.rollback_claim(claim)
+                rolled_back += 1
+        return finalized, rolled_back
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self) -> None:
+        totals_reconciled_at = None
+        while True:
+            try:
+                finalized, rolled_back = await self.reconcile()
+                if finalized or rolled_back:
+                    self._logger.info('Finalised %d and rolled back %d claims', finalized, rolled_back)
+            except Exception:
+                self._logger.exception('Failed to reconcile pending claims')
+            now = time.monotonic()
+            if totals_reconciled_at is None or now - totals_reconciled_at >= self._totals_interval:
+                totals_reconciled_at = now
+                try:
+                    users, total_claimed = await self._controller.reconcile_totals()
+                    self._logger.info('Reconciled claim totals of %d users, %d claimed in total', users, total_claimed)
+                except Exception:
+                    self._logger.exception('Failed to reconcile claim totals')
+            await asyncio.sleep(self._interval)
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
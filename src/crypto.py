@@ -1,22 +1,25 @@
 import asyncio
 import logging
 import enum
+import functools
 import json
 from dataclasses import dataclass
 from decimal import *
-from typing import Any, List, Optional, Union
-import base58
+from typing import Any, Iterable, List, Optional, Set, Tuple, Union
 
 from solders.pubkey import Pubkey
+from solders.hash import Hash
+from solders.instruction import Instruction
 from solders.keypair import Keypair
+from solders.rpc.responses import RpcBlockhash
+from solders.signature import Signature
+from solders.transaction_status import TransactionConfirmationStatus
 from solana.rpc.api import Client
-from solana.rpc.async_api import AsyncClient
 # from solana.transaction import Transaction, TransactionInstruction, AccountMeta
-from spl.token.async_client import AsyncToken
 from spl.token.constants import TOKEN_PROGRAM_ID
-from solana.rpc.types import TxOpts
+from solana.rpc.commitment import Confirmed
+from solana.rpc.types import TokenAccountOpts, TxOpts
 
-from solana.transaction import Transaction
 from spl.token.instructions import (
     get_associated_token_address,
     create_associated_token_account,
@@ -26,6 +29,15 @@ from spl.token.instructions import (
 from solders.system_program import TransferParams, transfer, create_account
 
 import settings
+from ata_cache import AtaCache
+from rpc_cache import BlockhashCache, PriorityFeeEstimator, set_compute_unit_price
+from rpc_pool import RpcPool
+from transaction_planner import SentTransaction, build_transactions, pack_bundles, submit_transactions
+
+# max number of accounts in one getMultipleAccounts request
+MAX_ACCOUNTS_PER_REQUEST = 100
+# max number of signatures in one getSignatureStatuses request
+MAX_SIGNATURES_PER_REQUEST = 256
 
 
 class BalanceType(enum.Enum):
@@ -37,9 +49,16 @@ class Recipient:
     address: Pubkey
     share: Decimal
 
+@dataclass
+class Drop:
+    receiver: Pubkey
+    token_amount: Decimal
+    sol_amount: Decimal
+
 class Crypto:
+    """BHUMI token operations. All RPC calls go through the process-wide `RpcPool`, use `get_crypto()`."""
 
-    def __init__(self):
+    def __init__(self, rpc: Optional[RpcPool] = None):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(logging.INFO)
 
@@ -51,28 +70,48 @@ class Crypto:
         self.daily_stash_keypair: Keypair = Keypair.from_base58_string(settings.SOLANA_DAILY_STASH_KEY)
         # self.receiver = self.daily_stash_keypair.pubkey()
 
-        self.solana_cli = AsyncClient('https://api.mainnet-beta.solana.com')
-        self.token = AsyncToken(self.solana_cli, self.token_pubkey, TOKEN_PROGRAM_ID,
-                                self.airdrop_keypair)
+        self.solana_cli = rpc or RpcPool()
+        self.blockhash_cache = BlockhashCache(self.solana_cli)
+        self.fee_estimator = PriorityFeeEstimator(self.solana_cli)
+        self.ata_cache = AtaCache(settings.ATA_CACHE_PATH)
 
     def generate_keypair(self) -> Keypair:
         kp = Keypair()
         return kp
 
     async def get_token_balance(self, pubkey: Pubkey) -> Decimal:
-        ans = await self.token.get_accounts_by_owner(pubkey)
+        ans = await self.solana_cli.get_token_accounts_by_owner(pubkey, TokenAccountOpts(mint=self.token_pubkey))
         if not ans.value:
             return Decimal(0)
         # print(ans)
         token_account = ans.value[0]
         # print(token_account)
-        balance = await self.token.get_balance(token_account.pubkey)
+        balance = await self.solana_cli.get_token_account_balance(token_account.pubkey)
         # print(balance.value)
         value = balance.value
         # print(value.decimals, value.amount)
         return Decimal(value.amount) / (Decimal(10) ** value.decimals)
 
-    async def transfer_all_with_ratios(self, bhumi_from: Keypair, fees_from: Keypair, recipients: List[Recipient]) -> Optional[str]:
+    async def get_missing_token_accounts(self, addresses: Iterable[Pubkey]) -> Set[Pubkey]:
+        """Returns which of the token accounts don't exist yet, checking the ones not in the cache in batches."""
+        unknown = list({address for address in addresses if address not in self.ata_cache})
+        existing = []
+        missing = set()
+        for i in range(0, len(unknown), MAX_ACCOUNTS_PER_REQUEST):
+            chunk = unknown[i:i + MAX_ACCOUNTS_PER_REQUEST]
+            ans = await self.solana_cli.get_multiple_accounts(chunk)
+            for address, account in zip(chunk, ans.value):
+                if account is None:
+                    missing.add(address)
+                else:
+                    existing.append(address)
+        self.ata_cache.add_many(existing)
+        return missing
+
+    async def transfer_all_with_ratios(self, bhumi_from: Keypair, fees_from: Keypair, recipients: List[Recipient],
+                                       dry_run: bool = False) -> List[str]:
+        """Splits the BHUMI balance of `bhumi_from` between recipients. Transfers are packed into as many
+        transactions as needed, returns their signatures."""
         self._logger.info(f'Sending bhumis from {bhumi_from.pubkey()} to {len(recipients)} recipients')
         shares_sum = Decimal(0)
         for recipient in recipients:
@@ -84,31 +123,32 @@ class Crypto:
         await asyncio.sleep(1)
         if bhumis_to_send <= Decimal("0.1"):
             self._logger.info(f'Not enough BHUMI to send: {bhumis_to_send}, skipping transfer to {len(recipients)} recipients')
-            return None
+            return []
 
-        txn = Transaction(fee_payer=fees_from.pubkey())
+        bundles = []
+        missing_accounts = await self.get_missing_token_accounts(
+            get_associated_token_address(recipient.address, self.token_pubkey) for recipient in recipients
+        )
         for recipient in recipients:
             receiver = recipient.address
-            associated_token_address = get_associated_token_address(receiver, self.token.pubkey)
+            associated_token_address = get_associated_token_address(receiver, self.token_pubkey)
+            bundle = []
 
-            # Check if the associated token account exists
-            token_account_info = await self.solana_cli.get_account_info(associated_token_address)
-
-            if token_account_info is None or token_account_info.value is None:
+            if associated_token_address in missing_accounts:
                 # Create associated token account if it does not exist
                 create_associated_token_account_ix = create_associated_token_account(
                     bhumi_from.pubkey(),
                     receiver,
-                    self.token.pubkey
+                    self.token_pubkey
                 )
-                txn.add(create_associated_token_account_ix)
+                bundle.append(create_associated_token_account_ix)
 
-            txn.add(
+            bundle.append(
                 transfer_checked(
                     TransferCheckedParams(
                         program_id=TOKEN_PROGRAM_ID,
-                        source=get_associated_token_address(bhumi_from.pubkey(), self.token.pubkey),
-                        mint=self.token.pubkey,
+                        source=get_associated_token_address(bhumi_from.pubkey(), self.token_pubkey),
+                        mint=self.token_pubkey,
                         dest=associated_token_address,
                         owner=bhumi_from.pubkey(),
                         amount=int(bhumis_to_send * recipient.share * (10 ** self.decimals)),
@@ -116,59 +156,125 @@ class Crypto:
                     )
                 )
             )
+            bundles.append(bundle)
         if bhumi_from != fees_from:
             signers = [bhumi_from, fees_from]
         else:
             signers = [bhumi_from]
-        ans = await self.solana_cli.send_transaction(txn, *signers)
-        self._logger.info(f"sent tx for {bhumis_to_send} bhumis to {len(recipients)} recipients")
-        return base58.b58encode(bytearray(ans.value.to_bytes_array())).decode('utf-8')
+        sent, _ = await self._send(fees_from.pubkey(), bundles, signers, dry_run)
+        errors = [transaction.error for transaction in sent if transaction.error]
+        if errors:
+            raise errors[0]
+        self._logger.info(f"sent {len(sent)} txs for {bhumis_to_send} bhumis to {len(recipients)} recipients")
+        return [transaction.signature for transaction in sent]
 
-    async def transfer_drop(self, receiver_str: str, token_balance_delta: Decimal, sol_balance_delta: Decimal) -> str:
-        receiver = Pubkey.from_string(receiver_str)
+    def _drop_bundle(self, drop: Drop, create_account: bool) -> List[Instruction]:
         origin = self.airdrop_keypair
-        txn = Transaction(fee_payer=origin.pubkey())
-        associated_token_address = get_associated_token_address(receiver, self.token.pubkey)
+        associated_token_address = get_associated_token_address(drop.receiver, self.token_pubkey)
+        instructions = []
 
-        # Check if the associated token account exists
-        token_account_info = await self.solana_cli.get_account_info(associated_token_address)
-
-        if token_account_info is None or token_account_info.value is None:
+        if create_account:
             # Create associated token account if it does not exist
             create_associated_token_account_ix = create_associated_token_account(
                 origin.pubkey(),
-                receiver,
-                self.token.pubkey
+                drop.receiver,
+                self.token_pubkey
             )
-            txn.add(create_associated_token_account_ix)
+            instructions.append(create_associated_token_account_ix)
 
-        txn.add(
+        instructions.append(
             transfer_checked(
                 TransferCheckedParams(
                     program_id=TOKEN_PROGRAM_ID,
-                    source=get_associated_token_address(origin.pubkey(), self.token.pubkey),
-                    mint=self.token.pubkey,
+                    source=get_associated_token_address(origin.pubkey(), self.token_pubkey),
+                    mint=self.token_pubkey,
                     dest=associated_token_address,
                     owner=origin.pubkey(),
-                    amount=int(token_balance_delta * (10 ** self.decimals)),
+                    amount=int(drop.token_amount * (10 ** self.decimals)),
                     decimals=self.decimals
                 )
             )
         )
 
-        sol_transfer_amount = int(sol_balance_delta * (10 ** 9))  # Convert SOL to lamports
-        txn.add(
+        sol_transfer_amount = int(drop.sol_amount * (10 ** 9))  # Convert SOL to lamports
+        instructions.append(
             transfer(
                 TransferParams(
                     from_pubkey=origin.pubkey(),
-                    to_pubkey=receiver,
+                    to_pubkey=drop.receiver,
                     lamports=sol_transfer_amount
                 )
             )
         )
+        return instructions
+
+    async def transfer_drops(self, drops: List[Drop]) -> List[SentTransaction]:
+        """Sends BHUMI and SOL from the airdrop wallet to several receivers, packed into as few transactions as
+        possible. Returns the transaction carrying each drop. Raises only if nothing was submitted.
+        Receivers have to be distinct, otherwise their token account could be created twice."""
+        if len({drop.receiver for drop in drops}) != len(drops):
+            raise ValueError('Receivers of drops in one batch have to be distinct')
+        missing_accounts = await self.get_missing_token_accounts(
+            get_associated_token_address(drop.receiver, self.token_pubkey) for drop in drops
+        )
+        bundles = [
+            self._drop_bundle(drop, get_associated_token_address(drop.receiver, self.token_pubkey) in missing_accounts)
+            for drop in drops
+        ]
+        # signed once and sent as raw bytes, so a retry on another endpoint can't send a second transfer
+        signers = [self.airdrop_keypair]
+        sent, placement = await self._send(self.airdrop_keypair.pubkey(), bundles, signers)
+        self._logger.info(f'sent {len(drops)} drops in {len(sent)} txs')
+        return [sent[i] for i in placement]
+
+    async def transfer_drop(self, receiver_str: str, token_balance_delta: Decimal, sol_balance_delta: Decimal) -> str:
+        sent = (await self.transfer_drops([Drop(Pubkey.from_string(receiver_str), token_balance_delta,
+                                                sol_balance_delta)]))[0]
+        if sent.error:
+            raise sent.error
+        return sent.signature
+
+    async def get_transaction_statuses(self, signatures: List[str]) -> List[Optional[bool]]:
+        """Whether each transaction succeeded, None for the ones which are not confirmed (yet)."""
+        statuses = []
+        for i in range(0, len(signatures), MAX_SIGNATURES_PER_REQUEST):
+            chunk = [Signature.from_string(signature) for signature in signatures[i:i + MAX_SIGNATURES_PER_REQUEST]]
+            ans = await self.solana_cli.get_signature_statuses(chunk, search_transaction_history=True)
+            for status in ans.value:
+                if status is not None and status.confirmation_status in (TransactionConfirmationStatus.Confirmed,
+                                                                          TransactionConfirmationStatus.Finalized):
+                    statuses.append(status.err is None)
+                else:
+                    statuses.append(None)
+        return statuses
+
+    async def get_block_height(self) -> int:
+        return (await self.solana_cli.get_block_height(Confirmed)).value
+
+    async def _send(self, fee_payer: Pubkey, bundles: List[List[Instruction]], signers: List[Keypair],
+                    dry_run: bool = False) -> Tuple[List[SentTransaction], List[int]]:
+        """Packs bundles into transactions paying the current priority fee and sends them with the cached
+        blockhash. Returns the transactions and, for every bundle, the index of its transaction.
+        A dry run uses zero fee and the default blockhash, so it needs no RPC calls."""
+        if dry_run:
+            fee, blockhash = 0, RpcBlockhash(Hash.default(), 0)
+        else:
+            fee, blockhash = await asyncio.gather(self.fee_estimator.get(), self.blockhash_cache.get())
+        plans, placement = pack_bundles(fee_payer, bundles, prefix=[set_compute_unit_price(fee)])
+        transactions = build_transactions(fee_payer, plans, signers, blockhash.blockhash)
+        sent = await submit_transactions(self.solana_cli, transactions, blockhash.last_valid_block_height, dry_run)
+        if any(transaction.error for transaction in sent):
+            # the blockhash may have expired, don't reuse it for the retry
+            self.blockhash_cache.invalidate()
+        return sent, placement
+
+    async def close(self) -> None:
+        self.blockhash_cache.close()
+        self.fee_estimator.close()
+        await self.solana_cli.close()
 
-        signers = [origin]
-        ans = await self.solana_cli.send_transaction(txn, *signers)
 
-        # return ans.get('result', None)
-        return base58.b58encode(bytearray(ans.value.to_bytes_array())).decode('utf-8')
+@functools.lru_cache(maxsize=None)
+def get_crypto() -> Crypto:
+    """The Crypto instance of the process."""
+    return Crypto()
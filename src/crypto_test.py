@@ -1,7 +1,7 @@
 import asyncio
 import logging
 
-from crypto import Crypto, Recipient
+from crypto import Recipient, get_crypto
 from decimal import Decimal
 import base58
 
@@ -12,7 +12,7 @@ from wallet_controller import WalletController
 async def main():
     MongoConnection.initialize()
     await WalletController.initialize()
-    crypto = Crypto()
+    crypto = get_crypto()
     wallet_controller = WalletController()
 
     wallets = await wallet_controller.get_all_wallets()
@@ -24,13 +24,15 @@ async def main():
             crypto.daily_stash_keypair,
             [Recipient(address=crypto.daily_stash_keypair.pubkey(), share=Decimal(1))],
         )
-        print(f'tx hash {res}')
+        print(f'tx hashes {res}')
         await asyncio.sleep(10)
+    await crypto.close()
 
 async def main2():
-    crypto = Crypto()
+    crypto = get_crypto()
     res = await crypto.transfer_drop('9GjrBqq4nVStvhN7xbP7NRwWfa5VwAL94D7hWkgcywdz', Decimal(1), Decimal('0.003'))
     print(res)
+    await crypto.close()
     # print(res.result.)
     # base58.b58encode_check(bytearray(res.value.to_bytes_array())).decode('utf-8')
 
@@ -2,13 +2,17 @@ import asyncio
 import logging
 import random
 from decimal import Decimal
+from typing import Awaitable, Callable, Dict, Optional, Set
 
 import discord
+from solders.pubkey import Pubkey
+from spl.token.instructions import get_associated_token_address
 
 import settings
-from crypto import Crypto, Recipient
+from account_subscriptions import TokenAccountSubscriptions
+from crypto import Recipient, get_crypto
 from mongo import MongoConnection
-from wallet_controller import WalletController
+from wallet_controller import Wallet, WalletController
 
 # class MyClient(discord.Client):
 #     async def on_ready(self):
@@ -31,7 +35,85 @@ from wallet_controller import WalletController
 
 bot = discord.Bot()
 wallet_controller = WalletController()
-crypto = Crypto()
+crypto = get_crypto()
+token_subscriptions = TokenAccountSubscriptions()
+# users who are being let in, so that a notification and a button press don't do it twice
+granting: Set[int] = set()
+# stop watching a wallet nobody paid to after this many seconds, the button still works
+WATCH_TIMEOUT = 60 * 60
+# token account -> timer which stops watching it
+watch_timers: Dict[Pubkey, asyncio.TimerHandle] = {}
+
+
+def access_embed(balance: Decimal) -> discord.Embed:
+    return discord.Embed(
+        title="Все получилось!",
+        description=f"Вижу на адресе {balance} BHUMI токенов ✨. Выдаю доступы!\n\n Теперь у тебя появились новые каналы. \nПрочитай сначала [это сообщение]({settings.DISCORD_INTRO_URL}), мы описали там с чего начать.")
+
+
+async def grant_access(member, wallet: Wallet, balance: Decimal,
+                       send_message: Callable[[discord.Embed], Awaitable[None]]) -> bool:
+    """Returns False without doing anything if access is already being granted to the member."""
+    if member.id in granting:
+        return False
+    granting.add(member.id)
+    try:
+        await unwatch_wallet(get_associated_token_address(wallet.pubkey, crypto.token_pubkey))
+        role = discord.utils.get(member.guild.roles, name="Открыватели")
+        await member.add_roles(role)
+        await send_message(access_embed(balance))
+        for i in range(10):
+            try:
+                await crypto.transfer_all_with_ratios(
+                    wallet.keypair,
+                    crypto.daily_stash_keypair,
+                    [Recipient(address=crypto.daily_stash_keypair.pubkey(), share=Decimal(1))]
+                )
+                break
+            except Exception as e:
+                logging.error(e)
+                await asyncio.sleep(60)
+    finally:
+        granting.discard(member.id)
+    return True
+
+
+async def unwatch_wallet(token_account: Pubkey) -> None:
+    timer = watch_timers.pop(token_account, None)
+    if timer:
+        timer.cancel()
+    await token_subscriptions.unsubscribe(token_account)
+
+
+async def watch_wallet(interaction, wallet: Wallet) -> None:
+    """Lets the user in as soon as the token account of the wallet gets enough BHUMI."""
+    member = interaction.user
+    token_account = get_associated_token_address(wallet.pubkey, crypto.token_pubkey)
+    if token_account in token_subscriptions:
+        return
+
+    async def send_message(embed: discord.Embed) -> None:
+        try:
+            # interaction tokens are valid for 15 minutes
+            await interaction.followup.send(embed=embed, ephemeral=True)
+        except discord.HTTPException:
+            await member.send(embed=embed)
+
+    async def on_balance(balance: Optional[Decimal]) -> None:
+        if balance is None:
+            # notifications may have been missed while reconnecting
+            balance = await crypto.get_token_balance(wallet.pubkey)
+        logging.info(f"Balance notification for {member.id} is {balance} at wallet {wallet.pubkey}")
+        if balance >= Decimal(settings.BHUMI_TO_ENTER):
+            await grant_access(member, wallet, balance, send_message)
+
+    await token_subscriptions.subscribe(token_account, on_balance)
+    # a timer left from an earlier watch of the same wallet would stop this one early
+    old_timer = watch_timers.pop(token_account, None)
+    if old_timer:
+        old_timer.cancel()
+    watch_timers[token_account] = asyncio.get_running_loop().call_later(
+        WATCH_TIMEOUT, lambda: asyncio.create_task(unwatch_wallet(token_account)))
 
 
 async def check_balance(interaction):
@@ -40,31 +122,19 @@ async def check_balance(interaction):
     logging.info(f"Balance for {interaction.user.id} is {balance} at wallet {wallet.pubkey}")
     if balance == Decimal(0):
         await interaction.response.send_message(
-            f"Пока что на адрес ничего не пришло, попробуй еще раз через 10 секунд.", ephemeral=True,
+            f"Пока что на адрес ничего не пришло. Как только токены придут, я сразу выдам доступ, или можешь проверить сам кнопкой ниже.", ephemeral=True,
             view=ViewCheckAgain())
+        await watch_wallet(interaction, wallet)
     elif balance < Decimal(settings.BHUMI_TO_ENTER):
         await interaction.response.send_message(f"Вижу на адресе {balance} BHUMI токенов. Этого недостаточно, нужно {settings.BHUMI_TO_ENTER}.", ephemeral=True,
                                                 view=ViewCheckAgain())
+        await watch_wallet(interaction, wallet)
     else:
-        role = discord.utils.get(interaction.user.guild.roles, name="Открыватели")
-        await interaction.user.add_roles(role)
-        embed = discord.Embed(
-            title="Все получилось!",
-            description=f"Вижу на адресе {balance} BHUMI токенов ✨. Выдаю доступы!\n\n Теперь у тебя появились новые каналы. \nПрочитай сначала [это сообщение]({settings.DISCORD_INTRO_URL}), мы описали там с чего начать.")
-        await interaction.response.send_message(
-            embed=embed,
-            ephemeral=True)
-        for i in range(10):
-            try:
-                await crypto.transfer_all_with_ratios(
-                    wallet.keypair,
-                    crypto.daily_stash_keypair,
-                    [Recipient(address=crypto.daily_stash_keypair.pubkey(), share=Decimal(1))]
-                )
-                break
-            except Exception as e:
-                logging.error(e)
-                await asyncio.sleep(60)
+        async def send_message(embed: discord.Embed) -> None:
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+
+        if not await grant_access(interaction.user, wallet, balance, send_message):
+            await interaction.response.send_message("Уже выдаю доступ, подожди немного.", ephemeral=True)
 
 
 class ViewCheckAgain(discord.ui.View):
@@ -95,6 +165,7 @@ class ViewYesIWant(discord.ui.View): # Create a class called MyView that subclas
             embed=embed,
             # f"Чтобы открыть 13 буми, отправь 13 BHUMI токенов на адрес {wallet.pubkey}.",
             ephemeral=True, view=ViewIveSent()) # Send a message when the button is clicked
+        await watch_wallet(interaction, wallet)
 
 async def first_message(member):
     logging.info(f"Sending first message to {member}")
@@ -9,9 +9,9 @@ import requests
 from solders.pubkey import Pubkey
 
 import settings
-from crypto import Crypto, Recipient
+from crypto import Recipient, get_crypto
 
-crypto = Crypto()
+crypto = get_crypto()
 PRECISION = 1000000
 logger = logging.getLogger(__name__)
 
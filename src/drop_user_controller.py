@@ -1,45 +1,232 @@
 from dataclasses import dataclass
 from datetime import timezone, datetime
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 from mongo import BaseMongoRepository
 
+# document with the global counters; it used to live in drop_users, the legacy one is removed on reconcile
+TOTALS_ID = '_totals'
+
 
 @dataclass
 class User:
     id: str
     claimed: int
+    # reserved by claims which are not finalised yet
+    pending: int = 0
+
+
+@dataclass
+class PendingClaim:
+    id: str
+    user_id: str
+    amount: int
+    wallet: str
+    ref: str
+    timestamp: datetime
+    # set once the transaction carrying the claim is submitted
+    signature: Optional[str] = None
+    last_valid_block_height: Optional[int] = None
+
+
+class ClaimConflictError(Exception):
+    pass
+
+
+class DropTotalsController(BaseMongoRepository):
+    """Global claim counters, in a collection of their own."""
+    _collection_name = 'drop_totals'
+    _indexes = []
+
+    async def get_claimed_total(self) -> Optional[int]:
+        totals = await self._find_one({'_id': TOTALS_ID})
+        return totals['claimed_total'] if totals else None
+
+    async def add_claimed(self, amount: int) -> None:
+        await self._update_one({'_id': TOTALS_ID}, {'$inc': {'claimed_total': amount}}, upsert=True)
+
+    async def set_claimed_total(self, claimed_total: int) -> None:
+        await self._update_one({'_id': TOTALS_ID}, {'$set': {'claimed_total': claimed_total}}, upsert=True)
+
 
 class DropUserController(BaseMongoRepository):
+    """
+    Airdrop claims of users.
+
+    A claim is first reserved: it is added to `pending_claims` and `pending_total` in one update, conditional on
+    the `version` of the document read to compute the claimable amount, so concurrent claims of the same user can't
+    reserve more than the allowance. After the transfer the claim is either finalised into `claims` or rolled back.
+    """
     _collection_name = 'drop_users'
-    _indexes = []
+    _indexes = [
+        ('pending_claims.id', {'name': 'pending_claims'}),
+    ]
+    _queries = [
+        ('users with pending claims', {'pending_claims.id': {'$exists': True}}, None),
+    ]
 
     def __init__(self):
         super().__init__()
+        self._totals = DropTotalsController()
+
+    @classmethod
+    async def initialize(cls):
+        await super().initialize()
+        await DropTotalsController.initialize()
 
     async def get_user(self, user_id: str) -> User:
-        user_dict = await self._find_one({'_id': user_id})
+        user_dict = await self._find_one({'_id': user_id}, {'claimed_total': 1, 'pending_total': 1})
         if not user_dict:
             return User(
                 id=user_id,
                 claimed=0,
             )
-        claimed = sum([d['amount'] for d in user_dict['claims']])
+        if 'claimed_total' not in user_dict:
+            # not backfilled yet, see reconcile_totals
+            claims_dict = await self._find_one({'_id': user_id}, {'claims.amount': 1})
+            user_dict['claimed_total'] = sum([d['amount'] for d in claims_dict.get('claims', [])])
         return User(
             id=user_dict['_id'],
-            claimed=claimed,
+            claimed=user_dict['claimed_total'],
+            pending=user_dict.get('pending_total', 0),
         )
 
     async def get_total_claimed(self) -> int:
-        total_claimed = 0
-        async for user in self._find({}):
-            total_claimed += sum([d['amount'] for d in user['claims']])
-        return total_claimed
-
-    async def add_claim(self, user_id: str, amount: int, wallet: str, ref: str) -> None:
-        await self._update_one({'_id': user_id}, {'$push': {'claims': {
-            'timestamp': datetime.now(tz=timezone.utc),
-            'amount': amount,
-            'wallet': wallet,
-            'ref': ref,
-        }}}, upsert=True)
+        claimed_total = await self._totals.get_claimed_total()
+        if claimed_total is None:
+            # not backfilled yet
+            _, claimed_total = await self.reconcile_totals()
+        return claimed_total
+
+    async def reserve_claim(self, user_id: str, allowance: int, wallet: str, ref: str,
+                            attempts: int = 5) -> Optional[PendingClaim]:
+        """Reserves what is left of the allowance, returns None if there is nothing to claim. Raises
+        ClaimConflictError if the user document kept changing under the reservation."""
+        for _ in range(attempts):
+            user_dict = await self._find_one({'_id': user_id}, {'claimed_total': 1, 'pending_total': 1, 'version': 1})
+            user_dict = user_dict or {}
+            claimed = user_dict.get('claimed_total')
+            if claimed is None and user_dict:
+                # not backfilled yet, the reservation backfills it
+                claims_dict = await self._find_one({'_id': user_id}, {'claims.amount': 1})
+                claimed = sum([d['amount'] for d in claims_dict.get('claims', [])])
+            claimed = claimed or 0
+            amount = allowance - claimed - user_dict.get('pending_total', 0)
+            if amount <= 0:
+                return None
+
+            claim = PendingClaim(
+                id=str(ObjectId()),
+                user_id=user_id,
+                amount=amount,
+                wallet=wallet,
+                ref=ref,
+                timestamp=datetime.now(tz=timezone.utc),
+            )
+            version = user_dict.get('version')
+            try:
+                result = await self._update_one(
+                    {'_id': user_id, 'version': version if version is not None else {'$exists': False}},
+                    {
+                        '$push': {'pending_claims': {
+                            'id': claim.id,
+                            'timestamp': claim.timestamp,
+                            'amount': claim.amount,
+                            'wallet': claim.wallet,
+                            'ref': claim.ref,
+                        }},
+                        '$inc': {'pending_total': amount, 'version': 1},
+                        '$set': {'claimed_total': claimed},
+                    },
+                    upsert=not user_dict,
+                )
+            except DuplicateKeyError:
+                # the document was created by a concurrent claim
+                continue
+            if result.matched_count or result.upserted_id is not None:
+                return claim
+        raise ClaimConflictError(f'Could not reserve a claim for user {user_id}')
 
+    async def set_claim_transaction(self, claim: PendingClaim, signature: str, last_valid_block_height: int) -> None:
+        claim.signature = signature
+        claim.last_valid_block_height = last_valid_block_height
+        await self._update_one(
+            {'_id': claim.user_id, 'pending_claims.id': claim.id},
+            {'$set': {
+                'pending_claims.$.signature': signature,
+                'pending_claims.$.last_valid_block_height': last_valid_block_height,
+            }},
+        )
+
+    async def get_pending_claims(self) -> List[PendingClaim]:
+        claims = []
+        async for user_dict in self._find({'pending_claims.id': {'$exists': True}}, {'pending_claims': 1}):
+            for claim_dict in user_dict['pending_claims']:
+                claims.append(PendingClaim(
+                    id=claim_dict['id'],
+                    user_id=user_dict['_id'],
+                    amount=claim_dict['amount'],
+                    wallet=claim_dict['wallet'],
+                    ref=claim_dict['ref'],
+                    timestamp=claim_dict['timestamp'],
+                    signature=claim_dict.get('signature'),
+                    last_valid_block_height=claim_dict.get('last_valid_block_height'),
+                ))
+        return claims
+
+    async def finalize_claim(self, claim: PendingClaim) -> None:
+        """Moves the claim into `claims`. The global counter is updated separately, if the process dies in between
+        it is off until the next `reconcile_totals`."""
+        result = await self._update_one({'_id': claim.user_id, 'pending_claims.id': claim.id}, {
+                '$pull': {'pending_claims': {'id': claim.id}},
+                '$push': {'claims': {
+                    'timestamp': claim.timestamp,
+                    'amount': claim.amount,
+                    'wallet': claim.wallet,
+                    'ref': claim.ref,
+                    'signature': claim.signature,
+                }},
+                '$inc': {'claimed_total': claim.amount, 'pending_total': -claim.amount, 'version': 1},
+        })
+        if result.modified_count:
+            await self._totals.add_claimed(claim.amount)
+
+    async def rollback_claim(self, claim: PendingClaim) -> None:
+        await self._update_one({'_id': claim.user_id, 'pending_claims.id': claim.id}, {
+            '$pull': {'pending_claims': {'id': claim.id}},
+            '$inc': {'pending_total': -claim.amount, 'version': 1},
+        })
+
+    async def reconcile_totals(self) -> Tuple[int, int]:
+        """
+        Recomputes claimed_total and pending_total of every user from the claims arrays, and the global counter
+        from them. This is the source of truth for the counters and runs on a schedule.
+
+        A user is only updated if the document didn't change since it was read. Claims finalised while this runs
+        may be missing from the global counter until the next run.
+        """
+        updates = []
+        total_claimed = 0
+        async for user in self._aggregate([
+            {'$match': {'_id': {'$ne': TOTALS_ID}}},
+            {'$project': {
+                'claimed_total': {'$sum': '$claims.amount'},
+                'pending_total': {'$sum': '$pending_claims.amount'},
+                'version': 1,
+            }},
+        ]):
+            total_claimed += user['claimed_total']
+            version = user.get('version')
+            updates.append(UpdateOne(
+                {'_id': user['_id'], 'version': version if version is not None else {'$exists': False}},
+                {'$set': {'claimed_total': user['claimed_total'], 'pending_total': user.get('pending_total', 0)}},
+            ))
+        if updates:
+            await self._bulk_write(updates, ordered=False)
+        await self._totals.set_claimed_total(total_claimed)
+        await self._delete_one({'_id': TOTALS_ID})
+        return len(updates), total_claimed
@@ -0,0 +1,145 @@
+"""
+Local stand-in for the Solana JSON-RPC API, used to exercise transfers without a node.
+
+It answers the methods Crypto calls with minimal valid results: every owner has one token account holding
+`--balance` BHUMI, about half of the other accounts exist, and sent transactions are decoded and counted but go
+nowhere. Serve it with
+
+    python src/fake_solana_rpc.py --serve
+
+and point SOLANA_RPC_URL at http://127.0.0.1:8899, or run
+
+    python src/fake_solana_rpc.py --recipients 300
+
+to split the balance between random recipients, once as a dry run and once sent to the stand-in, and check that
+both are packed into the same number of transactions under the size limit. Crypto still reads its keys from
+SOLANA_PRIVATE_KEY and SOLANA_DAILY_STASH_KEY.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import Counter
+from decimal import Decimal
+from typing import List
+
+import tornado.web
+from solders.hash import Hash
+from solders.keypair import Keypair
+from solders.pubkey import Pubkey
+from solders.transaction import Transaction
+
+from ata_cache import AtaCache
+from crypto import Crypto, Recipient
+from rpc_pool import RpcPool
+from transaction_planner import PACKET_DATA_SIZE
+
+logger = logging.getLogger(__name__)
+calls = Counter()
+sent_transactions: List[bytes] = []
+
+TOKEN_DECIMALS = 3
+
+
+def _account_exists(address: str) -> bool:
+    # stable across runs, so a dry run and a real run see the same accounts
+    return hashlib.sha256(address.encode()).digest()[0] % 2 == 0
+
+
+class RpcHandler(tornado.web.RequestHandler):
+    def initialize(self, balance: Decimal):
+        self._balance = balance
+
+    def post(self):
+        request = json.loads(self.request.body)
+        method, params = request['method'], request.get('params', [])
+        calls[method] += 1
+        context = {'slot': 1}
+
+        if method == 'getLatestBlockhash':
+            result = {'context': context, 'value': {'blockhash': str(Hash.new_unique()), 'lastValidBlockHeight': 150}}
+        elif method == 'getBlockHeight':
+            result = 1
+        elif method == 'getRecentPrioritizationFees':
+            result = [{'slot': slot, 'prioritizationFee': slot * 100} for slot in range(10)]
+        elif method == 'getTokenAccountsByOwner':
+            token_account = str(Pubkey.new_unique())
+            result = {'context': context, 'value': [{'pubkey': token_account, 'account': {
+                'lamports': 2039280, 'data': ['', 'base64'], 'owner': 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA',
+                'executable': False, 'rentEpoch': 0}}]}
+        elif method == 'getTokenAccountBalance':
+            amount = self._balance.scaleb(TOKEN_DECIMALS)
+            result = {'context': context, 'value': {'amount': str(int(amount)), 'decimals': TOKEN_DECIMALS,
+                                                    'uiAmount': float(self._balance),
+                                                    'uiAmountString': str(self._balance)}}
+        elif method == 'getMultipleAccounts':
+            result = {'context': context, 'value': [
+                {'lamports': 2039280, 'data': ['', 'base64'], 'owner': 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA',
+                 'executable': False, 'rentEpoch': 0} if _account_exists(address) else None
+                for address in params[0]
+            ]}
+        elif method == 'sendTransaction':
+            raw = base64.b64decode(params[0])
+            sent_transactions.append(raw)
+            result = str(Transaction.from_bytes(raw).signatures[0])
+        elif method == 'getSignatureStatuses':
+            result = {'context': context, 'value': [
+                {'slot': 1, 'confirmations': None, 'err': None, 'status': {'Ok': None},
+                 'confirmationStatus': 'finalized'}
+                for _ in params[0]
+            ]}
+        else:
+            self.finish(json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                    'error': {'code': -32601, 'message': 'Method not found'}}))
+            return
+        self.finish(json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result}))
+
+
+def make_app(balance: Decimal) -> tornado.web.Application:
+    return tornado.web.Application([(r'/', RpcHandler, {'balance': balance})])
+
+
+async def self_check(port: int, recipients_count: int, balance: Decimal) -> None:
+    make_app(balance).listen(port)
+    crypto = Crypto(RpcPool([f'http://127.0.0.1:{port}']))
+    crypto.ata_cache = AtaCache(os.path.join(tempfile.mkdtemp(), 'ata_cache.json'))
+    sender = Keypair()
+    recipients = [Recipient(Keypair().pubkey(), Decimal(1) / recipients_count) for _ in range(recipients_count - 1)]
+    recipients.append(Recipient(Keypair().pubkey(), Decimal(1) - sum(r.share for r in recipients)))
+    try:
+        planned = await crypto.transfer_all_with_ratios(sender, sender, recipients, dry_run=True)
+        assert not sent_transactions, 'dry run sent transactions'
+        logger.info('Dry run planned %d transactions, RPC calls: %s', len(planned), dict(calls))
+
+        signatures = await crypto.transfer_all_with_ratios(sender, sender, recipients)
+        assert len(signatures) == len(planned) == len(sent_transactions), (len(signatures), len(planned))
+        sizes = [len(raw) for raw in sent_transactions]
+        assert max(sizes) <= PACKET_DATA_SIZE, max(sizes)
+        logger.info('Sent %d transactions of %d-%d bytes', len(sizes), min(sizes), max(sizes))
+    finally:
+        await crypto.close()
+    logger.info('All checks passed')
+
+
+async def serve(port: int, balance: Decimal) -> None:
+    make_app(balance).listen(port)
+    logger.info('Serving fake Solana RPC on http://127.0.0.1:%d', port)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--balance', type=Decimal, default=Decimal('1000'), help='BHUMI on every token account')
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--serve', action='store_true', help='only serve, for pointing SOLANA_RPC_URL at it')
+    args = parser.parse_args()
+    if args.serve:
+        asyncio.run(serve(args.port, args.balance))
+    else:
+        asyncio.run(self_check(args.port, args.recipients, args.balance))
@@ -0,0 +1,139 @@
+"""
+Local stand-in for the Solana websocket API, used to exercise TokenAccountSubscriptions without a node.
+
+It answers accountSubscribe/accountUnsubscribe and sends accountNotification with a jsonParsed token balance
+when asked. Run
+
+    python src/fake_solana_ws.py
+
+to check subscribing, notifications, reconnecting and unsubscribing against it.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+from solders.pubkey import Pubkey
+
+from account_subscriptions import TokenAccountSubscriptions
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSolanaWs:
+    def __init__(self):
+        self.connections = set()
+        # account -> (connection, subscription id)
+        self.subscriptions: Dict[str, Tuple[object, int]] = {}
+        self._subscription_ids = itertools.count(1)
+
+    async def handle(self, ws, path: str = '/') -> None:
+        self.connections.add(ws)
+        try:
+            async for message in ws:
+                request = json.loads(message)
+                if request['method'] == 'accountSubscribe':
+                    subscription = next(self._subscription_ids)
+                    self.subscriptions[request['params'][0]] = (ws, subscription)
+                    result = subscription
+                elif request['method'] == 'accountUnsubscribe':
+                    result = False
+                    for account, (_, subscription) in list(self.subscriptions.items()):
+                        if subscription == request['params'][0]:
+                            del self.subscriptions[account]
+                            result = True
+                else:
+                    await ws.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                              'error': {'code': -32601, 'message': 'Method not found'}}))
+                    continue
+                await ws.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(ws)
+            for account, (connection, _) in list(self.subscriptions.items()):
+                if connection is ws:
+                    del self.subscriptions[account]
+
+    async def notify(self, account: Pubkey, amount: Decimal, decimals: int = 3) -> None:
+        ws, subscription = self.subscriptions[str(account)]
+        await ws.send(json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'accountNotification',
+            'params': {'subscription': subscription, 'result': {'context': {'slot': 1}, 'value': {
+                'lamports': 2039280,
+                'owner': 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA',
+                'executable': False,
+                'rentEpoch': 0,
+                'data': {'program': 'spl-token', 'space': 165, 'parsed': {'type': 'account', 'info': {
+                    'tokenAmount': {'amount': str(int(amount * 10 ** decimals)), 'decimals': decimals,
+                                    'uiAmountString': str(amount)},
+                }}},
+            }}},
+        }))
+
+    async def drop_connections(self) -> None:
+        for ws in list(self.connections):
+            await ws.close()
+
+
+async def _wait_for(condition, timeout: float = 5) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError('Timed out')
+        await asyncio.sleep(0.05)
+
+
+async def self_check(port: int, accounts_count: int, per_connection: int) -> None:
+    fake = FakeSolanaWs()
+    server = await websockets.serve(fake.handle, '127.0.0.1', port)
+    subscriptions = TokenAccountSubscriptions(f'ws://127.0.0.1:{port}', per_connection=per_connection)
+    balances: Dict[str, List[Optional[Decimal]]] = {}
+    accounts = [Pubkey.new_unique() for _ in range(accounts_count)]
+    try:
+        for account in accounts:
+            async def callback(balance: Optional[Decimal], account=str(account)) -> None:
+                balances.setdefault(account, []).append(balance)
+            await subscriptions.subscribe(account, callback)
+        await _wait_for(lambda: len(fake.subscriptions) == len(accounts))
+        expected_connections = -(-len(accounts) // per_connection)
+        assert len(fake.connections) == expected_connections, fake.connections
+        logger.info('Subscribed %d accounts over %d connections', len(accounts), len(fake.connections))
+
+        await fake.notify(accounts[0], Decimal('130'))
+        await _wait_for(lambda: balances.get(str(accounts[0])) == [Decimal('130')])
+        logger.info('Notification delivered')
+
+        await subscriptions.unsubscribe(accounts[0])
+        await _wait_for(lambda: str(accounts[0]) not in fake.subscriptions)
+        logger.info('Unsubscribed')
+
+        balances.clear()
+        await fake.drop_connections()
+        await _wait_for(lambda: len(fake.subscriptions) == len(accounts) - 1, timeout=10)
+        # after a reconnect every callback is asked to check the balance itself
+        await _wait_for(lambda: all(balances.get(str(account)) == [None] for account in accounts[1:]))
+        await fake.notify(accounts[-1], Decimal('5'))
+        await _wait_for(lambda: balances[str(accounts[-1])] == [None, Decimal('5')])
+        logger.info('Reconnected and subscribed again')
+    finally:
+        await subscriptions.close()
+        server.close()
+        await server.wait_closed()
+    logger.info('All checks passed')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--accounts', type=int, default=25)
+    parser.add_argument('--per-connection', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(self_check(args.port, args.accounts, args.per_connection))
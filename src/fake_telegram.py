@@ -0,0 +1,96 @@
+"""
+Local stand-in for the Telegram Bot API, used to exercise the bot in webhook mode without Telegram.
+
+It answers every Bot API method the bot calls with a minimal valid result and replays recorded updates (one JSON
+update per line) to the bot's webhook. Start the bot with
+
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python src/main.py webhook
+
+and then run
+
+    python src/fake_telegram.py updates.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+import settings
+
+logger = logging.getLogger(__name__)
+calls = Counter()
+
+
+def _fake_message(chat_id) -> dict:
+    calls['message_id'] += 1
+    return {
+        'message_id': calls['message_id'],
+        'date': int(time.time()),
+        'chat': {'id': int(chat_id or 0), 'type': 'private'},
+    }
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def post(self, token, method):
+        calls[method] += 1
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body or b'{}')
+        else:
+            params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method.startswith('send') or method.startswith('edit'):
+            result = _fake_message(params.get('chat_id'))
+        else:
+            result = True
+        self.finish(json.dumps({'ok': True, 'result': result}))
+
+    get = post
+
+
+async def replay(updates_file: str, webhook_url: str, concurrency: int) -> None:
+    client = AsyncHTTPClient()
+    headers = {'Content-Type': 'application/json'}
+    if settings.WEBHOOK_SECRET:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = settings.WEBHOOK_SECRET
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(line):
+        async with semaphore:
+            await client.fetch(HTTPRequest(webhook_url, method='POST', headers=headers, body=line))
+
+    with open(updates_file) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    started = time.monotonic()
+    await asyncio.gather(*(post(line) for line in lines))
+    logger.info('Replayed %d updates in %.2fs', len(lines), time.monotonic() - started)
+
+
+async def async_main(args) -> None:
+    app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotApiHandler)])
+    app.listen(args.port)
+    await asyncio.sleep(args.delay)
+    await replay(args.updates, args.webhook_url, args.concurrency)
+    # let the bot finish answering before reporting
+    await asyncio.sleep(args.delay)
+    logger.info('Bot API calls: %s', dict(calls))
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('updates', help='file with one recorded update JSON per line')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--webhook-url', default=f'http://127.0.0.1:{settings.WEBHOOK_PORT}/{settings.WEBHOOK_PATH}')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=5, help='seconds to wait for the bot to start and to finish')
+    asyncio.run(async_main(parser.parse_args()))
@@ -2,6 +2,7 @@ import datetime
 import json
 import time
 import settings
+from snapshot_format import write_snapshot
 from telethon import TelegramClient, sync
 
 
@@ -76,8 +77,12 @@ if __name__ == '__main__':
     print(f"found {len(user_dict)} users")
 
     # save this json to file with name of the channel
-    with open(f"{settings.SNAPSHOTS_DIR}{input('Enter json file name: ')}.json", 'w') as f:
-        f.write(json.dumps({'name': input('Назови группу: '), 'users': user_dict}))
+    file_name = input('Enter json file name: ')
+    group_name = input('Назови группу: ')
+    with open(f"{settings.SNAPSHOTS_DIR}{file_name}.json", 'w') as f:
+        f.write(json.dumps({'name': group_name, 'users': user_dict}))
+    # compact copy which is what the web process actually reads
+    write_snapshot(f"{settings.SNAPSHOTS_DIR}{file_name}.bin", group_name, user_dict)
 
     # for m in client.iter_messages(channel, limit=100, offset_id=mid):
     #     mid = m.id
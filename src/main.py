@@ -14,18 +14,24 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 import asyncio
-import itertools
 import logging
 import random
 from typing import Optional
 
+from bot_application import ChatSerialApplication
+from broadcast import Broadcaster
+from claim_reconciler import ClaimReconciler
+from crypto import get_crypto
 from distribute_stash import main_distribute_stash
+from drop_user_controller import DropUserController
 from wallet_controller import WalletController
 from web import main_web
 from telegram import __version__ as TG_VER
 import settings
 from mongo import MongoConnection
+from mongo_persistence import MongoPersistence, PersistenceController
 from photo_controller import PhotoController, Photo
+from train_index import TrainIndex, TRAIN_MODES
 from user_controller import UserController
 import argparse
 
@@ -48,7 +54,6 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
     CallbackQueryHandler,
 )
@@ -70,6 +75,8 @@ default_reply_keyboard = [
 default_markup = ReplyKeyboardMarkup(default_reply_keyboard, one_time_keyboard=True)
 user_controller = UserController()
 photo_controller = PhotoController()
+broadcaster = Broadcaster(user_controller)
+train_index = TrainIndex()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -153,9 +160,13 @@ async def receive_train_photo_mapping(update: Update, context: ContextTypes.DEFA
     bhumi = data[2]
 
     photo = await photo_controller.get_photo_by_id(photo_id)
+    mappers = await user_controller.get_users(mapping.mapper_id for mapping in photo.mappings)
     answers = ""
     for mapping in photo.mappings:
-        user_name = (await user_controller.get_user(mapping.mapper_id)).name
+        if mapping.mapper_id not in mappers:
+            # the user document is gone, its answer can't be attributed
+            continue
+        user_name = mappers[mapping.mapper_id].name
         mapping_comment = ""
         if mapping.comment:
             mapping_comment = f" ({mapping.comment})"
@@ -171,131 +182,23 @@ async def receive_train_photo_mapping(update: Update, context: ContextTypes.DEFA
     return DEFAULT_STATE
 
 
-def get_photo_collective_mapping(photo: Photo) -> Optional[str]:
-    for mapping in photo.mappings:
-        if mapping.mapper_id == settings.TRAIN_USER_ID:
-            return mapping.result
-    return None
-
-
-async def train01(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply_text = "Режим обучения. Твоя оценка не будет сохранена, но ты увидишь чужие. Вот два фото одного человека."
-    await update.message.reply_text(reply_text)
-    photos = await photo_controller.get_photos_for_train()
-    groups = []
-    for key, group in itertools.groupby(photos, lambda x: "{}-{}".format(x.user_id, x.name)):
-        groups.append(list(group))
-
-    random.shuffle(groups)
-    for group in groups:
-        group = list(group)
-        photos0 = [photo for photo in group if get_photo_collective_mapping(photo) == '0']
-        photosA = [photo for photo in group if get_photo_collective_mapping(photo) == '1']
-        if not photos0 or not photosA:
-            continue
-        photo0 = random.choice(photos0)
-        photoA = random.choice(photosA)
-        if random.random() > 0.5:
-            await send_train_photo(update, context, photo0)
-            await send_train_photo(update, context, photoA)
-        else:
-            await send_train_photo(update, context, photoA)
-            await send_train_photo(update, context, photo0)
-
+def make_train_handler(mode: str):
+    async def train(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        reply_text = "Режим обучения. Твоя оценка не будет сохранена, но ты увидишь чужие. Вот два фото одного человека."
+        await update.message.reply_text(reply_text)
+        pair = train_index.sample_pair(mode)
+        if pair is None:
+            reply_text = "Не получается найти достаточно фото."
+            await update.message.reply_text(reply_text)
+            return DEFAULT_STATE
+
+        photos = list(pair)
+        random.shuffle(photos)
+        for photo in photos:
+            await send_train_photo(update, context, photo)
         return DEFAULT_STATE
-    reply_text = "Не получается найти достаточно фото."
-    await update.message.reply_text(reply_text)
-    return DEFAULT_STATE
 
-
-async def train12(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply_text = "Режим обучения. Твоя оценка не будет сохранена, но ты увидишь чужие. Вот два фото одного человека."
-    await update.message.reply_text(reply_text)
-    photos = await photo_controller.get_photos_for_train()
-    groups = []
-    for key, group in itertools.groupby(photos, lambda x: "{}-{}".format(x.user_id, x.name)):
-        groups.append(list(group))
-
-    random.shuffle(groups)
-    for group in groups:
-        group = list(group)
-        photos0 = [photo for photo in group if get_photo_collective_mapping(photo) == '1']
-        photosA = [photo for photo in group if get_photo_collective_mapping(photo) == '2']
-        if not photos0 or not photosA:
-            continue
-        photo0 = random.choice(photos0)
-        photoA = random.choice(photosA)
-        if random.random() > 0.5:
-            await send_train_photo(update, context, photo0)
-            await send_train_photo(update, context, photoA)
-        else:
-            await send_train_photo(update, context, photoA)
-            await send_train_photo(update, context, photo0)
-
-        return DEFAULT_STATE
-    reply_text = "Не получается найти достаточно фото."
-    await update.message.reply_text(reply_text)
-    return DEFAULT_STATE
-
-
-async def train23(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply_text = "Режим обучения. Твоя оценка не будет сохранена, но ты увидишь чужие. Вот два фото одного человека."
-    await update.message.reply_text(reply_text)
-    photos = await photo_controller.get_photos_for_train()
-    groups = []
-    for key, group in itertools.groupby(photos, lambda x: "{}-{}".format(x.user_id, x.name)):
-        groups.append(list(group))
-
-    random.shuffle(groups)
-    for group in groups:
-        group = list(group)
-        photos0 = [photo for photo in group if get_photo_collective_mapping(photo) == '2']
-        photosA = [photo for photo in group if get_photo_collective_mapping(photo) == '3']
-        if not photos0 or not photosA:
-            continue
-        photo0 = random.choice(photos0)
-        photoA = random.choice(photosA)
-        if random.random() > 0.5:
-            await send_train_photo(update, context, photo0)
-            await send_train_photo(update, context, photoA)
-        else:
-            await send_train_photo(update, context, photoA)
-            await send_train_photo(update, context, photo0)
-
-        return DEFAULT_STATE
-    reply_text = "Не получается найти достаточно фото."
-    await update.message.reply_text(reply_text)
-    return DEFAULT_STATE
-
-
-async def train0a(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply_text = "Режим обучения. Твоя оценка не будет сохранена, но ты увидишь чужие. Вот два фото одного человека."
-    await update.message.reply_text(reply_text)
-    photos = await photo_controller.get_photos_for_train()
-    groups = []
-    for key, group in itertools.groupby(photos, lambda x: "{}-{}".format(x.user_id, x.name)):
-        groups.append(list(group))
-
-    random.shuffle(groups)
-    for group in groups:
-        group = list(group)
-        photos0 = [photo for photo in group if get_photo_collective_mapping(photo) == '0']
-        photosA = [photo for photo in group if get_photo_collective_mapping(photo) != '0' and get_photo_collective_mapping(photo) != 'N/A']
-        if not photos0 or not photosA:
-            continue
-        photo0 = random.choice(photos0)
-        photoA = random.choice(photosA)
-        if random.random() > 0.5:
-            await send_train_photo(update, context, photo0)
-            await send_train_photo(update, context, photoA)
-        else:
-            await send_train_photo(update, context, photoA)
-            await send_train_photo(update, context, photo0)
-
-        return DEFAULT_STATE
-    reply_text = "Не получается найти достаточно фото."
-    await update.message.reply_text(reply_text)
-    return DEFAULT_STATE
+    return train
 
 
 async def receive_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -346,11 +249,10 @@ async def handle_new_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, p
     if name:
         person_on_photo_suffix = f" ({name})"
     caption = "Новое фото для маппинга от {}{}!".format(user.name, person_on_photo_suffix)
-    for chat_id in subscribers:
-        await context.bot.send_photo(chat_id=chat_id,
-                                     photo=photo_id,
-                                     caption=caption,
-                                     reply_markup=markup)
+    broadcaster.enqueue(subscribers, 'send_photo',
+                        photo=photo_id,
+                        caption=caption,
+                        reply_markup=markup)
 
     return DEFAULT_STATE
 
@@ -380,7 +282,9 @@ async def receive_mapping_result(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_new_mapping(update: Update, context: ContextTypes.DEFAULT_TYPE, mapper_id: int,  photo_id: str, bhumi: str, comment: Optional[str]):
     mapper = await user_controller.get_user(mapper_id)
     owner = await photo_controller.get_photo_sender(photo_id)
-    await photo_controller.update_mapping_result(photo_id, mapper_id, bhumi, comment)
+    photo = await photo_controller.update_mapping_result(photo_id, mapper_id, bhumi, comment)
+    if mapper_id == settings.TRAIN_USER_ID:
+        train_index.update(photo)
 
     await context.bot.send_message(chat_id=mapper_id, text="Оценка сохранена, удачи!", reply_markup=default_markup)
     text = f"{mapper.name} отмапил твое фото.\nБуми: {bhumi}."
@@ -423,18 +327,51 @@ async def receive_mapping_comment(update: Update, context: ContextTypes.DEFAULT_
     )
 
 
+async def post_init(application: Application) -> None:
+    await train_index.load(photo_controller)
+    broadcaster.start(application.bot)
+
+
+async def post_shutdown(application: Application) -> None:
+    await broadcaster.stop()
+
+
 async def init():
     MongoConnection.initialize()
     await UserController.initialize()
     await PhotoController.initialize()
     await WalletController.initialize()
+    await PersistenceController.initialize()
 
 
-def main() -> None:
+async def reconcile_claims():
+    MongoConnection.initialize()
+    await DropUserController.initialize()
+    crypto = get_crypto()
+    finalized, rolled_back = await ClaimReconciler(DropUserController(), crypto).reconcile()
+    logger.info('Finalised %d and rolled back %d pending claims', finalized, rolled_back)
+    await crypto.close()
+    users, total_claimed = await DropUserController().reconcile_totals()
+    logger.info('Reconciled claim totals of %d users, %d claimed in total', users, total_claimed)
+
+
+def main(webhook: bool = False) -> None:
     """Run the bot."""
     # Create the Application and pass it your bot's token.
-    persistence = PicklePersistence(filepath="conversationbot")
-    application = Application.builder().token(settings.TELEGRAM_TOKEN).persistence(persistence).build()
+    persistence = MongoPersistence()
+    application = Application.builder()\
+        .application_class(ChatSerialApplication)\
+        .token(settings.TELEGRAM_TOKEN)\
+        .base_url(settings.TELEGRAM_BASE_URL)\
+        .http_version(settings.TELEGRAM_HTTP_VERSION)\
+        .concurrent_updates(settings.BOT_CONCURRENT_UPDATES)\
+        .persistence(persistence)\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)\
+        .build()
+
+    for mode in TRAIN_MODES:
+        application.add_handler(CommandHandler(mode, make_train_handler(mode)))
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -472,10 +409,6 @@ def main() -> None:
             CallbackQueryHandler(receive_train_photo_mapping, pattern=r"^trainmap_.*$"),
             CallbackQueryHandler(skip_mapping_comment, pattern=r"^mapcomment_no$"),
             CallbackQueryHandler(ask_mapping_comment, pattern=r"^mapcomment_yes$"),
-            application.add_handler(CommandHandler("train01", train01)),
-            application.add_handler(CommandHandler("train12", train12)),
-            application.add_handler(CommandHandler("train23", train23)),
-            application.add_handler(CommandHandler("train0a", train0a)),
             MessageHandler(filters.ALL, default_state)
         ],
         name="my_conversation",
@@ -488,20 +421,33 @@ def main() -> None:
     # application.add_handler(show_data_handler)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    if webhook:
+        application.run_webhook(
+            listen=settings.WEBHOOK_LISTEN,
+            port=settings.WEBHOOK_PORT,
+            url_path=settings.WEBHOOK_PATH,
+            webhook_url=settings.WEBHOOK_URL or None,
+            secret_token=settings.WEBHOOK_SECRET or None,
+            max_connections=settings.BOT_CONCURRENT_UPDATES,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("mode", help="what's going to be launched", choices=['bot', 'web', 'distribute_stash'])
+    parser.add_argument("mode", help="what's going to be launched", choices=['bot', 'webhook', 'web', 'distribute_stash', 'reconcile_claims'])
     args = parser.parse_args()
-    if args.mode == 'bot':
+    if args.mode in ('bot', 'webhook'):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(init())
-        main()
+        main(webhook=args.mode == 'webhook')
     if args.mode == 'distribute_stash':
         loop = asyncio.get_event_loop()
         loop.run_until_complete(init())
         main_distribute_stash()
     if args.mode == 'web':
         main_web()
+    if args.mode == 'reconcile_claims':
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(reconcile_claims())
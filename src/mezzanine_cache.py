@@ -0,0 +1,73 @@
+import hashlib
+import logging
+import os
+from typing import Callable, Set
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class MezzanineCache:
+    """
+    Directory of input clips transcoded once into a canonical format, so that mixing them again is a stream copy.
+
+    Files are looked up by key and built on a miss. A hit refreshes the file's mtime, and the least recently used
+    files are deleted once the directory grows over `max_bytes`. The directory is shared by all render processes,
+    hits and misses are counted per instance.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._in_use: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str, extension: str, build: Callable[[str], None]) -> str:
+        """Returns the path of the file for `key`, calling `build(path)` to create it if it is not cached."""
+        path = os.path.join(self._directory, key + extension)
+        self._in_use.add(path)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+                self.hits += 1
+                return path
+            except FileNotFoundError:
+                # evicted by another process in between
+                pass
+
+        self.misses += 1
+        # the temp name keeps the extension, ffmpeg picks the container by it
+        tmp_path = os.path.join(self._directory, f'.{key}.{os.getpid()}{extension}')
+        try:
+            build(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._evict()
+        return path
+
+    def _evict(self) -> None:
+        entries = [entry for entry in os.scandir(self._directory) if entry.is_file() and not entry.name.startswith('.')]
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self._max_bytes:
+                break
+            if entry.path in self._in_use:
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            logger.info('Evicted %s from the mezzanine cache', entry.name)
@@ -6,9 +6,11 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import settings
 
 import logging
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorCursor
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorCommandCursor, AsyncIOMotorCursor
+from pymongo import ASCENDING
+from pymongo.results import UpdateResult
 
 
 class MongoConnection:
@@ -38,10 +40,39 @@ class MongoConnection:
             cls.client.close()
 
 
+IndexKeys = Union[str, List[Tuple[str, Any]]]
+
+# index options that make two indexes with the same keys different
+_INDEX_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+
+def _normalize_index_keys(keys: IndexKeys) -> List[Tuple[str, Any]]:
+    if isinstance(keys, str):
+        return [(keys, ASCENDING)]
+    return list(keys)
+
+
+def _index_matches(existing: Dict, keys: List[Tuple[str, Any]], params: Dict) -> bool:
+    if list(existing['key'].items()) != keys:
+        return False
+    return all(existing.get(option) == params.get(option) for option in _INDEX_OPTIONS)
+
+
+def _has_collection_scan(plan: Any) -> bool:
+    if isinstance(plan, dict):
+        return plan.get('stage') == 'COLLSCAN' or any(_has_collection_scan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collection_scan(v) for v in plan)
+    return False
+
+
 class BaseMongoRepository:
     _collection_name: str
     _collection: AsyncIOMotorCollection
-    _indexes: List[Tuple[str, Dict]] = []
+    # (keys, create_index params); params must contain a unique "name"
+    _indexes: List[Tuple[IndexKeys, Dict]] = []
+    # (description, filter, sort) of the queries the repository runs, checked against the indexes on startup
+    _queries: List[Tuple[str, Dict, Optional[List[Tuple[str, Any]]]]] = []
     _logger = logging.getLogger(__name__)
 
     def __init__(self):
@@ -60,10 +91,39 @@ class BaseMongoRepository:
 
         db = client[settings.MONGO_DATABASE]
         cls._collection = db[cls._collection_name]
-        for index_name, index_params in cls._indexes:
-            cls._logger.info('Creating Mongo index "%s" ON "%s" collection...',
-                             index_name, cls._collection_name)
-            await cls._collection.create_index(index_name, **index_params)
+        await cls._reconcile_indexes()
+        await cls._report_collection_scans()
+
+    @classmethod
+    async def _reconcile_indexes(cls):
+        existing = {index['name']: index async for index in cls._collection.list_indexes()}
+        declared = set()
+        for index_keys, index_params in cls._indexes:
+            name = index_params['name']
+            keys = _normalize_index_keys(index_keys)
+            declared.add(name)
+            if name in existing:
+                if _index_matches(existing[name], keys, index_params):
+                    continue
+                cls._logger.info('Mongo index "%s" ON "%s" collection differs from declared one, dropping...',
+                                 name, cls._collection_name)
+                await cls._collection.drop_index(name)
+            cls._logger.info('Creating Mongo index "%s" ON "%s" collection...', name, cls._collection_name)
+            await cls._collection.create_index(keys, **index_params)
+        for name in existing.keys() - declared - {'_id_'}:
+            cls._logger.warning('Mongo index "%s" ON "%s" collection is not declared in %s',
+                                name, cls._collection_name, cls.__name__)
+
+    @classmethod
+    async def _report_collection_scans(cls):
+        for description, query, sort in cls._queries:
+            cursor = cls._collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = await cursor.explain()
+            if _has_collection_scan(explain['queryPlanner']['winningPlan']):
+                cls._logger.warning('Query "%s" ON "%s" collection does a full collection scan',
+                                    description, cls._collection_name)
 
     async def _replace_one(self, *args, **kwargs) -> None:
         await self._collection.replace_one(*args, **kwargs)
@@ -77,8 +137,26 @@ class BaseMongoRepository:
     async def _delete_one(self, *args, **kwargs) -> None:
         await self._collection.delete_one(*args, **kwargs)
 
-    async def _update_one(self, *args, **kwargs) -> None:
-        await self._collection.update_one(*args, **kwargs)
+    async def _update_one(self, *args, **kwargs) -> UpdateResult:
+        return await self._collection.update_one(*args, **kwargs)
+
+    async def _update_many(self, *args, **kwargs) -> UpdateResult:
+        return await self._collection.update_many(*args, **kwargs)
+
+    async def _bulk_write(self, *args, **kwargs) -> None:
+        await self._collection.bulk_write(*args, **kwargs)
+
+    async def _find_one_and_update(self, *args, **kwargs) -> Any:
+        return await self._collection.find_one_and_update(*args, **kwargs)
+
+    async def _count_documents(self, *args, **kwargs) -> int:
+        return await self._collection.count_documents(*args, **kwargs)
+
+    async def _estimated_document_count(self) -> int:
+        return await self._collection.estimated_document_count()
 
     def _find(self, *args, **kwargs) -> AsyncIOMotorCursor:
         return self._collection.find(*args, **kwargs)
+
+    def _aggregate(self, *args, **kwargs) -> AsyncIOMotorCommandCursor:
+        return self._collection.aggregate(*args, **kwargs)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+from copy import deepcopy
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+from mongo import BaseMongoRepository
+
+ConversationKey = Tuple[Any, ...]
+ConversationDict = Dict[ConversationKey, object]
+
+USER_DATA = 'user_data'
+CHAT_DATA = 'chat_data'
+CONVERSATION = 'conversation'
+
+
+class PersistenceController(BaseMongoRepository):
+    _collection_name = 'bot_persistence'
+    _indexes = [
+        ([('kind', ASCENDING), ('name', ASCENDING)], {
+            'name': 'conversations',
+            'partialFilterExpression': {'kind': CONVERSATION},
+        }),
+    ]
+    _queries = [
+        ('conversations by name', {'kind': CONVERSATION, 'name': ''}, None),
+    ]
+
+    def __init__(self):
+        super().__init__()
+
+    async def get_data(self, kind: str, entity_id: int) -> Optional[Dict]:
+        doc = await self._find_one({'_id': _data_doc_id(kind, entity_id)}, {'data': 1})
+        return doc['data'] if doc else None
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        conversations = {}
+        async for doc in self._find({'kind': CONVERSATION, 'name': name}, {'key': 1, 'state': 1}):
+            conversations[tuple(doc['key'])] = doc['state']
+        return conversations
+
+    async def write(self, operations: List) -> None:
+        await self._bulk_write(operations, ordered=True)
+
+
+def _data_doc_id(kind: str, entity_id: int) -> str:
+    return f'{kind}:{entity_id}'
+
+
+def _conversation_doc_id(name: str, key: ConversationKey) -> str:
+    return f'{CONVERSATION}:{name}:{json.dumps(list(key))}'
+
+
+def _is_plain_key(key: Any) -> bool:
+    return isinstance(key, str) and key and '.' not in key and not key.startswith('$')
+
+
+class MongoPersistence(BasePersistence):
+    """
+    Stores user_data, chat_data and conversation states in Mongo.
+
+    Only the changed keys are written: every update is diffed against the last persisted copy and turned into a
+    `$set`/`$unset` of single fields. Writes are collected for `flush_delay` seconds and sent in one bulk_write.
+    user_data and chat_data are loaded lazily, the first time an update for that user or chat is processed.
+    Conversation states are tiny and ConversationHandler needs all of them upfront, so those are read at startup
+    with a projection.
+    bot_data and callback_data are not used by the bot and are not stored.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, update_interval: float = 10, flush_delay: float = 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._controller = PersistenceController()
+        self._flush_delay = flush_delay
+        self._persisted: Dict[Tuple[str, int], Dict] = {}
+        self._pending: List = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return await self._controller.get_conversations(name)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        await self._load(USER_DATA, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        await self._load(CHAT_DATA, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._update_data(USER_DATA, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._update_data(CHAT_DATA, chat_id, data)
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop_data(USER_DATA, user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop_data(CHAT_DATA, chat_id)
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        doc_id = _conversation_doc_id(name, key)
+        if new_state is None:
+            self._schedule(DeleteOne({'_id': doc_id}))
+        else:
+            self._schedule(UpdateOne({'_id': doc_id}, {'$set': {
+                'kind': CONVERSATION,
+                'name': name,
+                'key': list(key),
+                'state': new_state,
+            }}, upsert=True))
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        try:
+            await self._write_pending()
+        except Exception:
+            self._logger.exception('Failed to persist %d operations on flush', len(self._pending))
+            raise
+
+    async def _load(self, kind: str, entity_id: int, data: Dict) -> None:
+        if (kind, entity_id) in self._persisted:
+            return
+        stored = await self._controller.get_data(kind, entity_id) or {}
+        self._persisted[(kind, entity_id)] = deepcopy(stored)
+        for key, value in stored.items():
+            data.setdefault(key, value)
+
+    def _update_data(self, kind: str, entity_id: int, data: Dict) -> None:
+        old = self._persisted.get((kind, entity_id), {})
+        if data == old:
+            return
+        self._persisted[(kind, entity_id)] = deepcopy(data)
+        if not all(_is_plain_key(key) for key in data) or not all(_is_plain_key(key) for key in old):
+            update = {'$set': {'data': data}}
+        else:
+            update = {}
+            changed = {f'data.{key}': value for key, value in data.items() if key not in old or old[key] != value}
+            removed = {f'data.{key}': '' for key in old if key not in data}
+            if changed:
+                update['$set'] = changed
+            if removed:
+                update['$unset'] = removed
+        update.setdefault('$set', {})['kind'] = kind
+        self._schedule(UpdateOne({'_id': _data_doc_id(kind, entity_id)}, update, upsert=True))
+
+    def _drop_data(self, kind: str, entity_id: int) -> None:
+        self._persisted.pop((kind, entity_id), None)
+        self._schedule(DeleteOne({'_id': _data_doc_id(kind, entity_id)}))
+
+    def _schedule(self, operation) -> None:
+        self._pending.append(operation)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self._flush_delay)
+            try:
+                await self._write_pending()
+            except Exception:
+                # the operations are back in self._pending, so the loop goes on and retries them
+                self._logger.exception('Failed to persist %d operations, retrying in %ss',
+                                       len(self._pending), self._flush_delay)
+
+    async def _write_pending(self) -> None:
+        operations, self._pending = self._pending, []
+        if not operations:
+            return
+        try:
+            await self._controller.write(operations)
+        except Exception:
+            # the writes are idempotent, so the ones which went through before the failure can be sent again
+            self._pending = operations + self._pending
+            raise
+        self._logger.debug('Persisted %d operations', len(operations))
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import tempfile
+from typing import Dict, Optional
+
+from tornado.httputil import HTTPHeaders, _parse_header
+
+# form fields other than files are kept in memory, so they are expected to be small
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    pass
+
+
+class UploadedFile:
+    """File part of a multipart body, written to a temp file in `directory` and hashed as it arrives."""
+
+    def __init__(self, directory: str, filename: str):
+        self.filename = filename
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MultipartStreamParser:
+    """
+    Incremental parser of multipart/form-data bodies.
+
+    Chunks are passed to `feed` as they are received. File parts are streamed into `UploadedFile`s in `directory`,
+    other fields are collected into `fields`. Only as much of the body as may contain a partial boundary is buffered.
+    """
+    _PREAMBLE, _HEADERS, _BODY, _AFTER_BOUNDARY, _DONE = range(5)
+
+    def __init__(self, boundary: bytes, directory: str):
+        self._delimiter = b'\r\n--' + boundary
+        self._directory = directory
+        self._buffer = b''
+        self._state = self._PREAMBLE
+        self._field_name: Optional[str] = None
+        self._field_value = b''
+        self._file: Optional[UploadedFile] = None
+        self.fields: Dict[str, str] = {}
+        self.files: Dict[str, UploadedFile] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self._state == self._DONE
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += data
+        while self._step():
+            pass
+
+    def discard(self) -> None:
+        for file in self.files.values():
+            file.discard()
+        if self._file:
+            self._file.discard()
+
+    def _step(self) -> bool:
+        if self._state == self._PREAMBLE:
+            # the first boundary is not preceded by CRLF
+            start = self._buffer.find(self._delimiter[2:])
+            if start == -1:
+                self._buffer = self._buffer[-len(self._delimiter):]
+                return False
+            self._buffer = self._buffer[start + len(self._delimiter) - 2:]
+            self._state = self._AFTER_BOUNDARY
+            return True
+
+        if self._state == self._AFTER_BOUNDARY:
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(b'--'):
+                self._buffer = b''
+                self._state = self._DONE
+                return False
+            if not self._buffer.startswith(b'\r\n'):
+                raise MultipartError('Malformed multipart boundary')
+            self._buffer = self._buffer[2:]
+            self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            end = self._buffer.find(b'\r\n\r\n')
+            if end == -1:
+                if len(self._buffer) > MAX_FIELD_SIZE:
+                    raise MultipartError('Multipart headers are too long')
+                return False
+            self._begin_part(self._buffer[:end].decode('utf-8'))
+            self._buffer = self._buffer[end + 4:]
+            self._state = self._BODY
+            return True
+
+        if self._state == self._BODY:
+            end = self._buffer.find(self._delimiter)
+            if end == -1:
+                # keep what may be the beginning of the delimiter for the next chunk
+                safe = len(self._buffer) - len(self._delimiter) + 1
+                if safe > 0:
+                    self._write(self._buffer[:safe])
+                    self._buffer = self._buffer[safe:]
+                return False
+            self._write(self._buffer[:end])
+            self._end_part()
+            self._buffer = self._buffer[end + len(self._delimiter):]
+            self._state = self._AFTER_BOUNDARY
+            return True
+
+        # epilogue after the closing boundary is ignored
+        self._buffer = b''
+        return False
+
+    def _begin_part(self, raw_headers: str) -> None:
+        headers = HTTPHeaders.parse(raw_headers)
+        disposition, params = _parse_header(headers.get('Content-Disposition', ''))
+        if disposition != 'form-data' or 'name' not in params:
+            raise MultipartError('Invalid multipart/form-data part')
+        self._field_name = params['name']
+        if 'filename' in params:
+            self._file = UploadedFile(self._directory, params['filename'])
+        else:
+            self._field_value = b''
+
+    def _write(self, data: bytes) -> None:
+        if self._file:
+            self._file.write(data)
+            return
+        self._field_value += data
+        if len(self._field_value) > MAX_FIELD_SIZE:
+            raise MultipartError(f'Field {self._field_name} is too long')
+
+    def _end_part(self) -> None:
+        if self._file:
+            self._file.close()
+            if self._field_name in self.files:
+                self.files[self._field_name].discard()
+            self.files[self._field_name] = self._file
+            self._file = None
+        else:
+            self.fields[self._field_name] = self._field_value.decode('utf-8')
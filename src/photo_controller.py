@@ -3,6 +3,7 @@ from datetime import datetime, timezone
 from typing import List, Dict
 
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 import settings
 from mongo import BaseMongoRepository
@@ -24,9 +25,20 @@ class Photo:
     mappings: List[MappingResult]
 
 
+TRAIN_MAPPING_FIELD = 'mappings.{}'.format(settings.TRAIN_USER_ID)
+
+
 class PhotoController(BaseMongoRepository):
     _collection_name = 'photos'
-    _indexes = []
+    _indexes = [
+        (TRAIN_MAPPING_FIELD, {
+            'name': 'train_mappings',
+            'partialFilterExpression': {TRAIN_MAPPING_FIELD: {'$exists': True}},
+        }),
+    ]
+    _queries = [
+        ('photos for train', {TRAIN_MAPPING_FIELD: {'$exists': True}}, None),
+    ]
 
     def __init__(self):
         super().__init__()
@@ -46,16 +58,17 @@ class PhotoController(BaseMongoRepository):
         photo = await self._find_one({'_id': ObjectId(obj_id)})
         return photo['user_id']
 
-    async def update_mapping_result(self, obj_id: str, mapper_id: int, result: str, comment: str = None):
+    async def update_mapping_result(self, obj_id: str, mapper_id: int, result: str, comment: str = None) -> Photo:
         payload = {
             'timestamp': datetime.now(tz=timezone.utc),
             'result': result,
         }
         if comment:
             payload['comment'] = comment
-        await self._update_one({'_id': ObjectId(obj_id)}, {
-            '$set': {'mappings': {str(mapper_id): payload}}
-        })
+        photo_dict = await self._find_one_and_update({'_id': ObjectId(obj_id)}, {
+            '$set': {'mappings.{}'.format(mapper_id): payload}
+        }, return_document=ReturnDocument.AFTER)
+        return _get_photo_from_dict(photo_dict)
 
     async def get_photo_by_id(self, obj_id: str) -> Photo:
         photo_dict = await self._find_one({'_id': ObjectId(obj_id)})
@@ -63,7 +76,7 @@ class PhotoController(BaseMongoRepository):
 
     async def get_photos_for_train(self) -> List[Photo]:
         ans = []
-        async for photo_dict in self._find({'mappings.{}'.format(settings.TRAIN_USER_ID): {'$exists': True}}):
+        async for photo_dict in self._find({TRAIN_MAPPING_FIELD: {'$exists': True}}):
             ans.append(_get_photo_from_dict(photo_dict))
         return ans
 
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import struct
+import time
+from typing import Generic, List, Optional, TypeVar
+
+from solders.instruction import Instruction
+from solders.pubkey import Pubkey
+from solders.rpc.responses import RpcBlockhash
+
+import settings
+from rpc_pool import RpcPool
+
+COMPUTE_BUDGET_PROGRAM_ID = Pubkey.from_string('ComputeBudget111111111111111111111111111111')
+# ComputeBudgetInstruction::SetComputeUnitPrice
+SET_COMPUTE_UNIT_PRICE = 3
+
+T = TypeVar('T')
+
+
+def set_compute_unit_price(micro_lamports: int) -> Instruction:
+    return Instruction(COMPUTE_BUDGET_PROGRAM_ID, bytes([SET_COMPUTE_UNIT_PRICE]) + struct.pack('<Q', micro_lamports), [])
+
+
+class _RefreshedValue(Generic[T]):
+    """
+    Value fetched over RPC and refreshed in the background every `refresh_interval` seconds.
+
+    The refresh task starts on the first `get()`. If the cached value is older than `max_age` (the refresh task
+    fell behind or failed), `get()` fetches it itself.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, rpc: RpcPool, refresh_interval: float, max_age: float):
+        self._rpc = rpc
+        self._refresh_interval = refresh_interval
+        self._max_age = max_age
+        self._value: Optional[T] = None
+        self._fetched_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        # created on the first get(), inside the loop which uses it: the caches are built at import time, and on
+        # Python 3.9 a lock binds to the loop current at creation
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def _fetch(self) -> T:
+        raise NotImplementedError
+
+    async def get(self) -> T:
+        if self._task is None:
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._refresh_loop())
+        if self._value is None or time.monotonic() - self._fetched_at > self._max_age:
+            async with self._lock:
+                # another caller may have fetched it while this one waited
+                if self._value is None or time.monotonic() - self._fetched_at > self._max_age:
+                    await self._refresh()
+        return self._value
+
+    def invalidate(self) -> None:
+        self._value = None
+
+    async def _refresh(self) -> None:
+        self._value = await self._fetch()
+        self._fetched_at = time.monotonic()
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                await self._refresh()
+            except Exception:
+                self._logger.exception('Failed to refresh %s', self.__class__.__name__)
+
+    def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+class BlockhashCache(_RefreshedValue[RpcBlockhash]):
+    """
+    Latest blockhash with the last block height it is valid at, so that sending a transaction doesn't need an
+    extra round trip.
+
+    A blockhash stays valid for 150 blocks, a bit over a minute; the cached one is used for at most `max_age`
+    seconds, well inside that window.
+    """
+
+    def __init__(self, rpc: RpcPool, refresh_interval: float = 10, max_age: float = 30):
+        super().__init__(rpc, refresh_interval, max_age)
+
+    async def _fetch(self) -> RpcBlockhash:
+        return (await self._rpc.get_latest_blockhash()).value
+
+
+class PriorityFeeEstimator(_RefreshedValue[int]):
+    """
+    Compute unit price in micro-lamports which recently got transactions into blocks: the `percentile` of the
+    prioritization fees paid in the last slots, capped at `max_fee`.
+    """
+
+    def __init__(self, rpc: RpcPool, accounts: Optional[List[Pubkey]] = None,
+                 percentile: int = settings.SOLANA_PRIORITY_FEE_PERCENTILE,
+                 max_fee: int = settings.SOLANA_MAX_PRIORITY_FEE,
+                 refresh_interval: float = 20, max_age: float = 60):
+        super().__init__(rpc, refresh_interval, max_age)
+        self._accounts = [str(account) for account in accounts or []]
+        self._percentile = percentile
+        self._max_fee = max_fee
+
+    async def _fetch(self) -> int:
+        fees = sorted(entry['prioritizationFee']
+                      for entry in await self._rpc.request('getRecentPrioritizationFees', [self._accounts]))
+        if not fees:
+            return 0
+        return min(fees[min(len(fees) - 1, len(fees) * self._percentile // 100)], self._max_fee)
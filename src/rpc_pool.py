@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+import httpx
+from solana.exceptions import SolanaRpcException
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.providers.async_http import AsyncHTTPProvider
+
+import settings
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# weight of the latest request in the moving average of endpoint latency
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class RpcError(Exception):
+    def __init__(self, method: str, error: Any):
+        super().__init__(f'{method} failed: {error}')
+        self.error = error
+
+
+class _PooledHTTPProvider(AsyncHTTPProvider):
+    """`AsyncHTTPProvider` over a given session instead of a default one of its own."""
+
+    def __init__(self, url: str, session: httpx.AsyncClient):
+        # skips AsyncHTTPProvider.__init__, which would open a session that is never used
+        super(AsyncHTTPProvider, self).__init__(url)
+        self.session = session
+
+
+class _PooledClient(AsyncClient):
+    """`AsyncClient` over a given session."""
+
+    def __init__(self, url: str, session: httpx.AsyncClient):
+        # skips AsyncClient.__init__, which would create a provider with a default session
+        super(AsyncClient, self).__init__()
+        self._provider = _PooledHTTPProvider(url, session)
+
+
+class RpcEndpoint:
+    def __init__(self, url: str, max_concurrency: int, timeout: float):
+        self.url = url
+        # one keep-alive pool per endpoint, multiplexed over HTTP/2 when h2 is installed
+        self.session = httpx.AsyncClient(
+            http2=HTTP2,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        self.client = _PooledClient(url, self.session)
+        self._max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.unavailable_until = 0.0
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use: the pool is built at import time, and on Python 3.9 a semaphore binds to the loop
+        # current at creation, not the one asyncio.run() starts later
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    async def request(self, method: str, params: List) -> Any:
+        """Plain JSON-RPC request, for methods `AsyncClient` doesn't have."""
+        response = await self.session.post(
+            self.url, json={'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params})
+        response.raise_for_status()
+        body = response.json()
+        if 'error' in body:
+            raise RpcError(method, body['error'])
+        return body['result']
+
+    def record_success(self, latency: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.latency
+        self.failures = 0
+
+    def record_failure(self, base_cooldown: float) -> None:
+        self.failures += 1
+        self.unavailable_until = time.monotonic() + base_cooldown * 2 ** min(self.failures - 1, 5)
+
+
+class RpcPool:
+    """
+    Solana RPC calls over a list of endpoints shared by the whole process.
+
+    Every call goes to the available endpoint with the lowest moving average latency; endpoints which were not
+    measured yet are tried first. An endpoint whose request failed on the transport level is skipped for a
+    cooldown which doubles with consecutive failures, and the call is retried on the next one. Each endpoint has
+    its own limit of concurrent requests.
+
+    Methods of `AsyncClient` are available on the pool itself, e.g. `await pool.get_balance(pubkey)`.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, urls: List[str] = settings.SOLANA_RPC_URLS,
+                 max_concurrency: int = settings.SOLANA_RPC_CONCURRENCY,
+                 timeout: float = 10, cooldown: float = 5):
+        if not urls:
+            raise ValueError('At least one RPC endpoint is required')
+        self._endpoints = [RpcEndpoint(url, max_concurrency, timeout) for url in urls]
+        self._cooldown = cooldown
+
+    def _ordered_endpoints(self) -> List[RpcEndpoint]:
+        now = time.monotonic()
+        available = [e for e in self._endpoints if e.unavailable_until <= now]
+        unavailable = [e for e in self._endpoints if e.unavailable_until > now]
+        available.sort(key=lambda e: -1 if e.latency is None else e.latency)
+        unavailable.sort(key=lambda e: e.unavailable_until)
+        return available + unavailable
+
+    async def call(self, method: str, *args, **kwargs) -> Any:
+        return await self._call(method, lambda endpoint: getattr(endpoint.client, method)(*args, **kwargs))
+
+    async def request(self, method: str, params: List) -> Any:
+        """Calls a JSON-RPC method by name and returns the raw result."""
+        return await self._call(method, lambda endpoint: endpoint.request(method, params))
+
+    async def _call(self, method: str, make_call: Callable[[RpcEndpoint], Awaitable[Any]]) -> Any:
+        error = None
+        for endpoint in self._ordered_endpoints():
+            async with endpoint.semaphore:
+                started = time.monotonic()
+                try:
+                    result = await make_call(endpoint)
+                except (SolanaRpcException, httpx.HTTPError) as e:
+                    endpoint.record_failure(self._cooldown)
+                    self._logger.warning('RPC %s failed on %s: %s', method, endpoint.url, e)
+                    error = e
+                    continue
+                endpoint.record_success(time.monotonic() - started)
+                return result
+        raise error
+
+    def __getattr__(self, method: str) -> Callable[..., Awaitable[Any]]:
+        if method.startswith('_') or not callable(getattr(AsyncClient, method, None)):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+    async def close(self) -> None:
+        for endpoint in self._endpoints:
+            # closes the session as well
+            await endpoint.client.close()
@@ -8,18 +8,58 @@ MONGO_DATABASE = os.getenv('MONGO_DATABASE', 'development')
 # telegram settings
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', 'Tokennnnn')
 TRAIN_USER_ID = int(os.getenv('TRAIN_USER_ID', '11'))
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
+# '2' switches the Bot API client to HTTP/2, needs the h2 package
+TELEGRAM_HTTP_VERSION = os.getenv('TELEGRAM_HTTP_VERSION', '1.1')
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '16'))
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_GLOBAL_RATE = float(os.getenv('BROADCAST_GLOBAL_RATE', '25'))
+BROADCAST_PER_CHAT_RATE = float(os.getenv('BROADCAST_PER_CHAT_RATE', '1'))
 
 # web settings
 VIDEO_ROOT = os.getenv('VIDEO_ROOT', './videos')
 WEB_USERNAME = os.getenv('WEB_USERNAME', 'a')
 WEB_PASS = os.getenv('WEB_PASS', 'aa')
+VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', str(os.cpu_count() or 1)))
+VIDEO_JOB_TIMEOUT = int(os.getenv('VIDEO_JOB_TIMEOUT', '1800'))
+VIDEO_JOB_MAX_ATTEMPTS = int(os.getenv('VIDEO_JOB_MAX_ATTEMPTS', '3'))
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', str(2 * 1024 * 1024 * 1024)))
+MEZZANINE_DIR = os.getenv('MEZZANINE_DIR', os.path.join(VIDEO_ROOT, 'mezzanine'))
+MEZZANINE_CACHE_BYTES = int(os.getenv('MEZZANINE_CACHE_BYTES', str(20 * 1024 * 1024 * 1024)))
+# internal nginx location that maps to the download directory, downloads are handed over to it when set
+DOWNLOAD_ACCEL_REDIRECT = os.getenv('DOWNLOAD_ACCEL_REDIRECT', '')
+# hand downloads over to apache/lighttpd with X-Sendfile
+DOWNLOAD_X_SENDFILE = os.getenv('DOWNLOAD_X_SENDFILE', '') == '1'
 COOKIE_SECRET = "your_cookie_secret"
+QR_CACHE_BYTES = int(os.getenv('QR_CACHE_BYTES', str(32 * 1024 * 1024)))
 
 # drop settings
 SNAPSHOTS_DIR = os.getenv('SNAPSHOTS_DIR', './data/snapshots/')
 SOL_DROP_AMOUNT = Decimal(os.getenv('SOL_DROP_AMOUNT', '0.003'))
 BHUMI_DROP_BASE = int(os.getenv('BHUMI_DROP_BASE', '13'))
 SOLANA_PRIVATE_KEY = os.getenv('SOLANA_PRIVATE_KEY', '123')
+SOLANA_RPC_URL = os.getenv('SOLANA_RPC_URL', 'https://api.mainnet-beta.solana.com')
+# comma separated, calls go to the fastest available one
+SOLANA_RPC_URLS = [url.strip() for url in os.getenv('SOLANA_RPC_URLS', SOLANA_RPC_URL).split(',') if url.strip()]
+SOLANA_RPC_CONCURRENCY = int(os.getenv('SOLANA_RPC_CONCURRENCY', '8'))
+# compute unit price in micro-lamports, picked from the fees paid in recent slots
+SOLANA_PRIORITY_FEE_PERCENTILE = int(os.getenv('SOLANA_PRIORITY_FEE_PERCENTILE', '75'))
+SOLANA_MAX_PRIORITY_FEE = int(os.getenv('SOLANA_MAX_PRIORITY_FEE', '100000'))
+# balance notifications, accounts are spread over connections of up to this many subscriptions each
+SOLANA_WS_URL = os.getenv('SOLANA_WS_URL', SOLANA_RPC_URL.replace('http', 'ws', 1))
+SOLANA_WS_SUBSCRIPTIONS_PER_CONNECTION = int(os.getenv('SOLANA_WS_SUBSCRIPTIONS_PER_CONNECTION', '100'))
+ATA_CACHE_PATH = os.getenv('ATA_CACHE_PATH', './data/ata_cache.json')
+# drops requested within the window are sent together
+AIRDROP_BATCH_WINDOW = float(os.getenv('AIRDROP_BATCH_WINDOW', '0.05'))
+AIRDROP_MAX_BATCH = int(os.getenv('AIRDROP_MAX_BATCH', '32'))
+# pending claims are finalised or rolled back by the status of their transactions this often
+CLAIM_RECONCILE_INTERVAL = float(os.getenv('CLAIM_RECONCILE_INTERVAL', '10'))
+CLAIM_TOTALS_RECONCILE_INTERVAL = float(os.getenv('CLAIM_TOTALS_RECONCILE_INTERVAL', '600'))
 
 # tg parser settings
 TG_API_ID = os.getenv('TG_API_ID', '123')
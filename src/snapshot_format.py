@@ -0,0 +1,113 @@
+"""
+Compact binary format for chat membership snapshots.
+
+Layout, all little-endian:
+
+    header   magic b'BHSNAP01', count: u64, name_len: u32, reserved: u32
+    name     utf-8, zero-padded to a multiple of 8 bytes
+    ids      count x i64, sorted ascending
+    messages count x u32, messages sent by the user with the same index
+    days     count x i32, day of the last message, days since 1970-01-01
+
+Files are memory-mapped and searched by bisection, so opening one costs nothing and lookups are O(log n).
+
+Run `python src/snapshot_format.py data/snapshots/*.json` to convert existing JSON snapshots.
+"""
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Optional, Tuple
+
+MAGIC = b'BHSNAP01'
+HEADER = struct.Struct('<8sQII')
+EPOCH = datetime.date(1970, 1, 1)
+EXTENSION = '.bin'
+
+
+def _pad(length: int) -> int:
+    return (length + 7) // 8 * 8
+
+
+def write_snapshot(path: str, name: str, users: Dict[str, Dict]) -> int:
+    rows = []
+    for user_id, stats in users.items():
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            continue
+        day = datetime.date.fromisoformat(stats['last_message_timestamp']) - EPOCH
+        rows.append((user_id, stats['messages_sent'], day.days))
+    rows.sort()
+
+    name_bytes = name.encode('utf-8')
+    count = len(rows)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, len(name_bytes), 0))
+        f.write(name_bytes.ljust(_pad(len(name_bytes)), b'\0'))
+        f.write(struct.pack(f'<{count}q', *(row[0] for row in rows)))
+        f.write(struct.pack(f'<{count}I', *(row[1] for row in rows)))
+        f.write(struct.pack(f'<{count}i', *(row[2] for row in rows)))
+    os.replace(tmp_path, path)
+    return count
+
+
+class BinarySnapshot:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, name_len, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a snapshot file')
+        self.name = self._mmap[HEADER.size:HEADER.size + name_len].decode('utf-8')
+        self._ids_offset = HEADER.size + _pad(name_len)
+        self._messages_offset = self._ids_offset + 8 * self._count
+        self._days_offset = self._messages_offset + 4 * self._count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._find(user_id) is not None
+
+    def _find(self, user_id: int) -> Optional[int]:
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<q', self._mmap, self._ids_offset + 8 * mid)[0] < user_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and struct.unpack_from('<q', self._mmap, self._ids_offset + 8 * lo)[0] == user_id:
+            return lo
+        return None
+
+    def get_stats(self, user_id: int) -> Optional[Tuple[int, datetime.date]]:
+        """Returns (messages sent, day of the last message) of the user, or None if they are not in the snapshot."""
+        i = self._find(user_id)
+        if i is None:
+            return None
+        messages_sent = struct.unpack_from('<I', self._mmap, self._messages_offset + 4 * i)[0]
+        days = struct.unpack_from('<i', self._mmap, self._days_offset + 4 * i)[0]
+        return messages_sent, EPOCH + datetime.timedelta(days=days)
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+def convert_json_snapshot(json_path: str) -> str:
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    path = os.path.splitext(json_path)[0] + EXTENSION
+    count = write_snapshot(path, data['name'], data['users'])
+    print(f'{json_path} -> {path}: {count} users')
+    return path
+
+
+if __name__ == '__main__':
+    for json_path in sys.argv[1:]:
+        convert_json_snapshot(json_path)
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Tuple, Union
+
+import settings
+from snapshot_format import BinarySnapshot, EXTENSION as BINARY_EXTENSION
+
+# groups which give an extra allowance on top of the per-group one
+BONUS_GROUPS = frozenset(["Шмит16", "Syntony"])
+NO_GROUPS_DETAILS = 'ни в каких'
+
+Signature = Tuple[Tuple[str, float, int], ...]
+
+
+@lru_cache(maxsize=None)
+def _get_allowance(groups: FrozenSet[str]) -> Tuple[int, str]:
+    # many users share the same set of groups, so every combination is computed once
+    details = NO_GROUPS_DETAILS
+    allowance_user = settings.BHUMI_DROP_BASE
+
+    if groups:
+        details = ', '.join(sorted(groups))
+        allowance_user += settings.BHUMI_DROP_BASE * len(groups)
+        if groups & BONUS_GROUPS:
+            allowance_user += settings.BHUMI_DROP_BASE * 2
+
+    return allowance_user, details
+
+
+class JsonSnapshot:
+    """Snapshot in the legacy JSON format, kept for groups which were not converted to the binary one yet."""
+
+    def __init__(self, path: str):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self.name = data['name']
+        self._ids = frozenset(int(user_id) for user_id in data['users'] if user_id.lstrip('-').isdigit())
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._ids
+
+    def close(self) -> None:
+        pass
+
+
+Snapshot = Union[BinarySnapshot, JsonSnapshot]
+
+
+def _parse_user_id(user_id: str) -> Optional[int]:
+    try:
+        return int(user_id)
+    except ValueError:
+        return None
+
+
+class SnapshotIndex:
+    """
+    Group membership of users found in the chat snapshots.
+
+    Binary snapshots are memory-mapped and searched by bisection; a JSON snapshot is only read when there is no
+    binary file with the same name next to it. The directory is re-checked at most every `check_interval`
+    seconds. When any snapshot file is added, removed or changes its mtime or size, all snapshots are reopened
+    and then swapped in at once.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, snapshots_dir: str = settings.SNAPSHOTS_DIR, check_interval: float = 5):
+        self._snapshots_dir = snapshots_dir
+        self._check_interval = check_interval
+        self._checked_at = 0.0
+        self._signature: Signature = ()
+        self._snapshots: List[Snapshot] = []
+
+    def get_allowance(self, user_id: str) -> Tuple[int, str]:
+        self._maybe_reload()
+        parsed_user_id = _parse_user_id(user_id)
+        if parsed_user_id is None:
+            return _get_allowance(frozenset())
+        return _get_allowance(frozenset(s.name for s in self._snapshots if parsed_user_id in s))
+
+    def _get_signature(self) -> Signature:
+        entries = {entry.name: entry for entry in os.scandir(self._snapshots_dir)}
+        signature = []
+        for file_name, entry in entries.items():
+            base_name, extension = os.path.splitext(file_name)
+            if extension == BINARY_EXTENSION or (extension == '.json' and base_name + BINARY_EXTENSION not in entries):
+                stat = entry.stat()
+                signature.append((file_name, stat.st_mtime, stat.st_size))
+        return tuple(sorted(signature))
+
+    def _maybe_reload(self) -> None:
+        if time.monotonic() - self._checked_at < self._check_interval:
+            return
+        signature = self._get_signature()
+        if signature != self._signature:
+            old_snapshots = self._snapshots
+            self._snapshots = self._open(signature)
+            self._signature = signature
+            for snapshot in old_snapshots:
+                snapshot.close()
+        self._checked_at = time.monotonic()
+
+    def _open(self, signature: Signature) -> List[Snapshot]:
+        snapshots = []
+        for file_name, _, _ in signature:
+            path = os.path.join(self._snapshots_dir, file_name)
+            if file_name.endswith(BINARY_EXTENSION):
+                snapshots.append(BinarySnapshot(path))
+            else:
+                snapshots.append(JsonSnapshot(path))
+        self._logger.info('Opened %d snapshots with %d memberships',
+                          len(snapshots), sum(len(s) for s in snapshots))
+        return snapshots
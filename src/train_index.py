@@ -0,0 +1,121 @@
+import logging
+import random
+from typing import Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+import settings
+from photo_controller import Photo, PhotoController
+
+T = TypeVar('T', bound=Hashable)
+
+SCORES = ['N/A'] + [str(bhumi) for bhumi in range(0, 14)]
+
+# training mode -> (scores of the first photo, scores of the second photo)
+TRAIN_MODES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+    'train01': (('0',), ('1',)),
+    'train12': (('1',), ('2',)),
+    'train23': (('2',), ('3',)),
+    'train0a': (('0',), tuple(score for score in SCORES if score not in ('0', 'N/A'))),
+}
+
+
+class RandomSet(Generic[T]):
+    """Set with O(1) add, remove and uniform random choice."""
+
+    def __init__(self):
+        self._items: List[T] = []
+        self._positions: Dict[T, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, item: T) -> bool:
+        return item in self._positions
+
+    def add(self, item: T) -> None:
+        if item in self._positions:
+            return
+        self._positions[item] = len(self._items)
+        self._items.append(item)
+
+    def discard(self, item: T) -> None:
+        position = self._positions.pop(item, None)
+        if position is None:
+            return
+        last = self._items.pop()
+        if position < len(self._items):
+            self._items[position] = last
+            self._positions[last] = position
+
+    def choice(self) -> T:
+        return random.choice(self._items)
+
+
+def get_photo_collective_mapping(photo: Photo) -> Optional[str]:
+    for mapping in photo.mappings:
+        if mapping.mapper_id == settings.TRAIN_USER_ID:
+            return mapping.result
+    return None
+
+
+def _get_group(photo: Photo) -> str:
+    return "{}-{}".format(photo.user_id, photo.name)
+
+
+class TrainIndex:
+    """
+    In-memory index of train photos keyed by (person group, collective score).
+
+    For every training mode it also keeps the set of groups that have photos on both sides of the pair, so a
+    valid pair is sampled without scanning photos.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, str], RandomSet[str]] = {}
+        self._photos: Dict[str, Photo] = {}
+        self._keys: Dict[str, Tuple[str, str]] = {}
+        self._eligible_groups: Dict[str, RandomSet[str]] = {mode: RandomSet() for mode in TRAIN_MODES}
+
+    async def load(self, photo_controller: PhotoController) -> None:
+        for photo in await photo_controller.get_photos_for_train():
+            self.update(photo)
+        self._logger.info('Loaded %d train photos into the index', len(self._photos))
+
+    def update(self, photo: Photo) -> None:
+        photo_id = str(photo.id)
+        score = get_photo_collective_mapping(photo)
+        old_key = self._keys.pop(photo_id, None)
+        if old_key:
+            self._buckets[old_key].discard(photo_id)
+            self._photos.pop(photo_id)
+        if score is not None:
+            key = (_get_group(photo), score)
+            self._buckets.setdefault(key, RandomSet()).add(photo_id)
+            self._keys[photo_id] = key
+            self._photos[photo_id] = photo
+        for group in {key[0] for key in (old_key, self._keys.get(photo_id)) if key}:
+            self._refresh_group(group)
+
+    def sample_pair(self, mode: str) -> Optional[Tuple[Photo, Photo]]:
+        groups = self._eligible_groups[mode]
+        if not groups:
+            return None
+        group = groups.choice()
+        first_scores, second_scores = TRAIN_MODES[mode]
+        return self._sample_photo(group, first_scores), self._sample_photo(group, second_scores)
+
+    def _count(self, group: str, scores: Tuple[str, ...]) -> int:
+        return sum(len(self._buckets.get((group, score), ())) for score in scores)
+
+    def _refresh_group(self, group: str) -> None:
+        for mode, (first_scores, second_scores) in TRAIN_MODES.items():
+            if self._count(group, first_scores) and self._count(group, second_scores):
+                self._eligible_groups[mode].add(group)
+            else:
+                self._eligible_groups[mode].discard(group)
+
+    def _sample_photo(self, group: str, scores: Tuple[str, ...]) -> Photo:
+        # pick a bucket proportionally to its size, so every photo of the class is equally likely
+        buckets = [self._buckets[(group, score)] for score in scores if self._buckets.get((group, score))]
+        bucket = random.choices(buckets, weights=[len(b) for b in buckets])[0]
+        return self._photos[bucket.choice()]
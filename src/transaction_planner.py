@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+from solana.transaction import Transaction
+from solders.hash import Hash
+from solders.instruction import Instruction
+from solders.keypair import Keypair
+from solders.message import Message
+from solders.pubkey import Pubkey
+
+from rpc_pool import RpcPool
+
+# max size of a serialized transaction, IPv6 MTU minus headers
+PACKET_DATA_SIZE = 1232
+SIGNATURE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+# instructions which have to end up in the same transaction, e.g. creating a token account and transferring to it
+Bundle = Sequence[Instruction]
+
+
+def _short_vec_size(value: int) -> int:
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def measure_transaction_size(fee_payer: Pubkey, instructions: Sequence[Instruction]) -> int:
+    """Size of the signed transaction on the wire. Accounts shared by instructions are only counted once, so the
+    size of a transaction is not the sum of the sizes of its bundles."""
+    message = Message(list(instructions), fee_payer)
+    signatures = message.header.num_required_signatures
+    return _short_vec_size(signatures) + SIGNATURE_SIZE * signatures + len(bytes(message))
+
+
+def pack_bundles(fee_payer: Pubkey, bundles: Sequence[Bundle], max_size: int = PACKET_DATA_SIZE,
+                 prefix: Bundle = ()) -> Tuple[List[List[Instruction]], List[int]]:
+    """Packs bundles into as few transactions under `max_size` as possible, placing every bundle into the first
+    transaction it still fits in. The order of bundles within a transaction is kept. Every transaction starts
+    with the `prefix` instructions, e.g. compute budget ones. Returns the transactions and, for every bundle, the
+    index of the transaction it was placed in."""
+    plans: List[List[Instruction]] = []
+    placement: List[int] = []
+    for bundle in bundles:
+        if measure_transaction_size(fee_payer, list(prefix) + list(bundle)) > max_size:
+            raise ValueError(f'Bundle of {len(bundle)} instructions does not fit into a transaction')
+        for i, plan in enumerate(plans):
+            if measure_transaction_size(fee_payer, plan + list(bundle)) <= max_size:
+                plan.extend(bundle)
+                placement.append(i)
+                break
+        else:
+            placement.append(len(plans))
+            plans.append(list(prefix) + list(bundle))
+    return plans, placement
+
+
+def plan_transactions(fee_payer: Pubkey, bundles: Sequence[Bundle], max_size: int = PACKET_DATA_SIZE,
+                      prefix: Bundle = ()) -> List[List[Instruction]]:
+    return pack_bundles(fee_payer, bundles, max_size, prefix)[0]
+
+
+def build_transactions(fee_payer: Pubkey, plans: Sequence[Sequence[Instruction]], signers: Sequence[Keypair],
+                       recent_blockhash: Hash) -> List[Transaction]:
+    transactions = []
+    for instructions in plans:
+        txn = Transaction(recent_blockhash=recent_blockhash, fee_payer=fee_payer, instructions=instructions)
+        txn.sign(*signers)
+        transactions.append(txn)
+    return transactions
+
+
+@dataclass
+class SentTransaction:
+    signature: str
+    # the transaction can't land after this block height
+    last_valid_block_height: int
+    # why submitting failed; the transaction may still have reached a node and land
+    error: Optional[Exception] = None
+
+
+async def submit_transactions(client: RpcPool, transactions: Sequence[Transaction], last_valid_block_height: int,
+                              dry_run: bool = False) -> List[SentTransaction]:
+    """
+    Submits signed transactions concurrently, in the order of `transactions`. Doesn't raise: a failed submission
+    is recorded in `error`, as the transaction may have reached a node before the call failed.
+
+    In dry-run mode nothing is submitted.
+    """
+    sent = [SentTransaction(str(txn.signature()), last_valid_block_height) for txn in transactions]
+    if not dry_run:
+        results = await asyncio.gather(*(client.send_raw_transaction(txn.serialize()) for txn in transactions),
+                                       return_exceptions=True)
+        for transaction, result in zip(sent, results):
+            if isinstance(result, Exception):
+                transaction.error = result
+        failed = [transaction for transaction in sent if transaction.error]
+        if failed:
+            logger.error('%d of %d transactions failed: %s', len(failed), len(sent),
+                         ', '.join(f'{t.signature} ({t.error})' for t in failed))
+    logger.info('%s %d transactions: %s', 'Planned' if dry_run else 'Sent', len(sent),
+                ', '.join(t.signature for t in sent))
+    return sent
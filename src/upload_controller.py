@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from mongo import BaseMongoRepository
+
+
+@dataclass
+class Upload:
+    name: str
+    sha256: str
+    stored_file: str
+    size: int
+    timestamp: datetime
+
+
+class UploadController(BaseMongoRepository):
+    """Names users gave to uploaded files. Files themselves are stored once per content, named by their sha256."""
+    _collection_name = 'uploads'
+    _indexes = [
+        ([('sha256', ASCENDING)], {'name': 'sha256'}),
+    ]
+    _queries = [
+        ('names of a file', {'sha256': ''}, None),
+    ]
+
+    def __init__(self):
+        super().__init__()
+
+    async def add_upload(self, name: str, sha256: str, stored_file: str, size: int) -> Optional[Upload]:
+        """Maps `name` to the stored file. Returns None if the name is already taken by a different file."""
+        upload = Upload(name=name, sha256=sha256, stored_file=stored_file, size=size,
+                        timestamp=datetime.now(tz=timezone.utc))
+        try:
+            await self._insert_one({
+                '_id': name,
+                'sha256': sha256,
+                'stored_file': stored_file,
+                'size': size,
+                'timestamp': upload.timestamp,
+            })
+        except DuplicateKeyError:
+            existing = await self.get_upload(name)
+            return existing if existing and existing.sha256 == sha256 else None
+        return upload
+
+    async def get_upload(self, name: str) -> Optional[Upload]:
+        upload = await self._find_one({'_id': name})
+        return _get_upload_from_dict(upload) if upload else None
+
+    async def is_stored(self, sha256: str) -> bool:
+        """Whether any name refers to the file with this content."""
+        return await self._find_one({'sha256': sha256}, {'_id': 1}) is not None
+
+    async def get_uploads(self, names: Iterable[str]) -> Dict[str, Upload]:
+        uploads = {}
+        async for upload in self._find({'_id': {'$in': list(set(names))}}):
+            uploads[upload['_id']] = _get_upload_from_dict(upload)
+        return uploads
+
+
+def _get_upload_from_dict(d: Dict) -> Upload:
+    return Upload(
+        name=d['_id'],
+        sha256=d['sha256'],
+        stored_file=d['stored_file'],
+        size=d['size'],
+        timestamp=d['timestamp'],
+    )
@@ -1,4 +1,7 @@
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
 
 from mongo import BaseMongoRepository
 
@@ -10,28 +13,98 @@ class User:
     subscribed_to_mapping_requests: bool
 
 
+class UserCache:
+    """Process-wide LRU cache of users with a TTL, so repeated callbacks don't re-read the same documents."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._users: 'OrderedDict[int, Tuple[float, User]]' = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[User]:
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires < time.monotonic():
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def put(self, user: User) -> None:
+        self._users[user.id] = (time.monotonic() + self._ttl, user)
+        self._users.move_to_end(user.id)
+        while len(self._users) > self._max_size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._users.pop(user_id, None)
+
+
 class UserController(BaseMongoRepository):
     _collection_name = 'users'
-    _indexes = []
+    _indexes = [
+        ('subscribed_to_mapping_requests', {
+            'name': 'subscribed_to_mapping_requests',
+            'partialFilterExpression': {'subscribed_to_mapping_requests': True},
+        }),
+    ]
+    _queries = [
+        ('users subscribed to mapping requests', {'subscribed_to_mapping_requests': True}, None),
+    ]
+    _projection = {'name': 1, 'subscribed_to_mapping_requests': 1}
+    _cache = UserCache()
 
     def __init__(self):
         super().__init__()
 
     async def get_user(self, user_id: int) -> User:
-        user_dict = await self._find_one({'_id': user_id})
-        return User(
-            id=user_dict['_id'],
-            name=user_dict['name'],
-            subscribed_to_mapping_requests=user_dict['subscribed_to_mapping_requests']
-        )
+        user = self._cache.get(user_id)
+        if user is None:
+            user_dict = await self._find_one({'_id': user_id}, self._projection)
+            user = _get_user_from_dict(user_dict)
+            self._cache.put(user)
+        return user
+
+    async def get_users(self, user_ids: Iterable[int]) -> Dict[int, User]:
+        """Users by id, ids without a user document are left out."""
+        users = {}
+        missing = []
+        for user_id in set(user_ids):
+            user = self._cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+        if missing:
+            async for user_dict in self._find({'_id': {'$in': missing}}, self._projection):
+                user = _get_user_from_dict(user_dict)
+                self._cache.put(user)
+                users[user.id] = user
+            not_found = [user_id for user_id in missing if user_id not in users]
+            if not_found:
+                self._logger.warning('Users %s not found', not_found)
+        return users
 
     async def update_name(self, user_id: int, name: str):
         await self._update_one({'_id': user_id}, {'$set': {'name': name}}, upsert=True)
+        self._cache.invalidate(user_id)
 
     async def update_mapping_request_subscription(self, user_id: int, subscribed_to_mapping_requests: bool):
         await self._update_one({'_id': user_id},
                                {'$set': {'subscribed_to_mapping_requests': subscribed_to_mapping_requests}},
                                upsert=True)
+        self._cache.invalidate(user_id)
 
     async def get_users_subscribed_to_mapping_requests(self) -> list[int]:
-        return [user['_id'] async for user in self._find({'subscribed_to_mapping_requests': True})]
+        return [user['_id'] async for user in self._find({'subscribed_to_mapping_requests': True}, {'_id': 1})]
+
+
+def _get_user_from_dict(d: Dict) -> User:
+    return User(
+        id=d['_id'],
+        name=d['name'],
+        # documents created by update_name alone don't have it yet
+        subscribed_to_mapping_requests=d.get('subscribed_to_mapping_requests', False)
+    )
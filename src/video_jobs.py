@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import string
+import time
+import traceback
+import uuid
+from typing import Dict, List, Optional
+
+import settings
+from mezzanine_cache import MezzanineCache
+from video_mix_controller import VideoMix, VideoMixController
+from video_renderer import generate_video_mix
+
+# render processes are started fresh instead of forked from the process running the event loop and mongo threads
+_mp_context = multiprocessing.get_context('spawn')
+
+
+class NoVideoException(Exception):
+    pass
+
+
+class _ProgressSender:
+    """Sends ('progress', frames done, frames total) through `conn`, at most once per `interval` seconds."""
+
+    def __init__(self, conn, interval: float = 0.25):
+        self._conn = conn
+        self._interval = interval
+        self._sent_at = 0.0
+
+    def __call__(self, frames_done: int, frames_total: int) -> None:
+        now = time.monotonic()
+        if now - self._sent_at >= self._interval or frames_done >= frames_total:
+            self._conn.send(('progress', frames_done, frames_total))
+            self._sent_at = now
+
+
+def render_job(video_files: List[str], source_hashes: Optional[List[str]], output_file: str, conn) -> None:
+    """Entry point of a render process. Sends progress while rendering, then ('ok', mezzanine cache stats)
+    or ('error', message) through `conn`."""
+    logging.basicConfig(level=logging.INFO)
+    cache = MezzanineCache(settings.MEZZANINE_DIR, settings.MEZZANINE_CACHE_BYTES)
+    try:
+        for file in video_files:
+            if not os.path.exists(file):
+                raise NoVideoException(f'File {os.path.split(file)[1]} does not exist')
+        generate_video_mix(video_files, output_file, cache, source_hashes, _ProgressSender(conn))
+    except Exception as e:
+        traceback.print_exc()
+        conn.send(('error', str(e)))
+    else:
+        conn.send(('ok', {'hits': cache.hits, 'misses': cache.misses}))
+    finally:
+        conn.close()
+
+
+class VideoMixWorker:
+    """
+    Renders video mixes queued in the `videos` collection.
+
+    Up to `processes` mixes are rendered at the same time, each one in its own process, so moviepy is not limited
+    by the GIL and a stuck render can be killed. A mix is claimed with a lease which is renewed while it renders;
+    mixes whose lease expired (the worker died) are put back into the queue on startup. Rendering is aborted on
+    timeout or when cancellation is requested.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, controller: VideoMixController, output_dir: str,
+                 processes: int = settings.VIDEO_WORKERS,
+                 job_timeout: float = settings.VIDEO_JOB_TIMEOUT,
+                 max_attempts: int = settings.VIDEO_JOB_MAX_ATTEMPTS,
+                 lease_seconds: float = 60,
+                 poll_interval: float = 5,
+                 progress_interval: float = 0.5):
+        self._controller = controller
+        self._output_dir = output_dir
+        self._processes = processes
+        self._job_timeout = job_timeout
+        self._max_attempts = max_attempts
+        self._lease_seconds = lease_seconds
+        self._poll_interval = poll_interval
+        self._progress_interval = progress_interval
+        self._worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._mezzanine_stats = {'hits': 0, 'misses': 0}
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        recovered = await self._controller.recover_orphaned_mixes(self._max_attempts)
+        if recovered:
+            self._logger.info('Recovered %d orphaned video mixes', recovered)
+        self._tasks = [asyncio.create_task(self._loop()) for _ in range(self._processes)]
+        self._logger.info('Started video mix worker %s with %d processes', self._worker_id, self._processes)
+
+    def get_mezzanine_stats(self) -> Dict[str, int]:
+        """Mezzanine cache hits and misses of the mixes rendered by this worker."""
+        return dict(self._mezzanine_stats)
+
+    def notify(self) -> None:
+        """Wakes idle workers up right away instead of on the next poll."""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                mix = await self._controller.claim_next_mix(self._worker_id, self._lease_seconds)
+            except Exception:
+                self._logger.exception('Failed to claim a video mix')
+                mix = None
+            if mix is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(mix)
+            except Exception as e:
+                self._logger.exception('Failed to render video mix %s', mix.id)
+                await self._controller.mark_mix_as_failed(mix.id, str(e))
+
+    async def _run(self, mix: VideoMix) -> None:
+        output_name = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(6)) + '.mp4'
+        output_path = os.path.join(self._output_dir, output_name)
+        parent_conn, child_conn = _mp_context.Pipe(duplex=False)
+        process = _mp_context.Process(target=render_job, daemon=True,
+                                      args=(mix.file_pathes, mix.input_hashes, output_path, child_conn))
+        process.start()
+        child_conn.close()
+        self._logger.info('Rendering video mix %s in process %s', mix.id, process.pid)
+
+        started = time.monotonic()
+        lease_renewed = started
+        progress_written = started
+        progress = None
+        result = None
+        try:
+            while result is None:
+                try:
+                    while result is None and parent_conn.poll():
+                        message = parent_conn.recv()
+                        if message[0] == 'progress':
+                            progress = message[1:]
+                        else:
+                            result = message
+                except EOFError:
+                    result = ('error', 'Render process exited without a result')
+                if result is not None:
+                    break
+                if progress is not None and time.monotonic() - progress_written >= self._progress_interval:
+                    await self._write_progress(mix, started, *progress)
+                    progress_written = time.monotonic()
+                    progress = None
+                if not process.is_alive():
+                    result = ('error', f'Render process exited with code {process.exitcode}')
+                    break
+                if time.monotonic() - started > self._job_timeout:
+                    self._logger.warning('Video mix %s timed out', mix.id)
+                    await self._controller.mark_mix_as_failed(mix.id, f'Timed out after {self._job_timeout}s')
+                    return
+                if time.monotonic() - lease_renewed > self._lease_seconds / 3:
+                    lease = await self._controller.renew_lease(mix.id, self._worker_id, self._lease_seconds)
+                    lease_renewed = time.monotonic()
+                    if lease is None:
+                        self._logger.warning('Lost the lease of video mix %s', mix.id)
+                        return
+                    if lease.get('cancel_requested'):
+                        self._logger.info('Video mix %s was cancelled', mix.id)
+                        await self._controller.mark_mix_as_cancelled(mix.id)
+                        return
+                await asyncio.sleep(0.5)
+        finally:
+            if process.is_alive():
+                process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, process.join)
+            parent_conn.close()
+            if (result is None or result[0] != 'ok') and os.path.exists(output_path):
+                os.remove(output_path)
+
+        status, details = result
+        if status == 'ok':
+            for counter, value in details.items():
+                self._mezzanine_stats[counter] += value
+            self._logger.info('Rendered video mix %s, mezzanine cache: %d hits, %d misses (%d hits, %d misses total)',
+                              mix.id, details['hits'], details['misses'],
+                              self._mezzanine_stats['hits'], self._mezzanine_stats['misses'])
+            await self._controller.mark_mix_as_succeed(mix.id, output_name)
+        else:
+            await self._controller.mark_mix_as_failed(mix.id, details)
+
+    async def _write_progress(self, mix: VideoMix, started: float, frames_done: int, frames_total: int) -> None:
+        eta = None
+        if 0 < frames_done < frames_total:
+            eta = (time.monotonic() - started) / frames_done * (frames_total - frames_done)
+        await self._controller.update_progress(mix.id, frames_done, frames_total, eta)
@@ -1,16 +1,26 @@
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import List, Dict, Optional
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Tuple
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
 import settings
 from mongo import BaseMongoRepository
 from enum import Enum
 
 
 class Status(Enum):
+    QUEUED = "queued"
     PROCESSING = "processing"
     SUCCEED = "succeed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@dataclass
+class RenderProgress:
+    frames_done: int
+    frames_total: int
+    eta_seconds: Optional[float]
 
 
 @dataclass
@@ -22,32 +32,198 @@ class VideoMix:
     output_file: Optional[str]
     timestamp_started: datetime
     timestamp_finished: Optional[datetime]
+    file_pathes: List[str]
+    input_hashes: Optional[List[str]]
+    progress: Optional[RenderProgress]
+
+
+@dataclass
+class VideoMixListItem:
+    id: ObjectId
+    task_string: str
+    status: Status
+    output_file: Optional[str]
+    timestamp_started: datetime
+
+
+# (timestamp_started, _id) of the last mix on a page, the next page starts after it
+PageCursor = Tuple[datetime, ObjectId]
 
 
 class VideoMixController(BaseMongoRepository):
     _collection_name = 'videos'
-    _indexes = []
+    _indexes = [
+        ([('timestamp_started', DESCENDING), ('_id', DESCENDING)], {'name': 'timestamp_started'}),
+        ([('status', ASCENDING), ('timestamp_started', ASCENDING)], {'name': 'status_timestamp_started'}),
+        ([('input_hashes', ASCENDING)], {
+            'name': 'succeed_input_hashes',
+            'partialFilterExpression': {'status': Status.SUCCEED.value},
+        }),
+    ]
+    _queries = [
+        ('page of mixes, newest first', {'timestamp_started': {'$lte': datetime.now()}},
+         [('timestamp_started', DESCENDING), ('_id', DESCENDING)]),
+        ('active mixes', {'status': Status.PROCESSING.value}, None),
+        ('next queued mix', {'status': Status.QUEUED.value}, [('timestamp_started', ASCENDING)]),
+        ('mixes with expired lease', {'status': Status.PROCESSING.value, 'lease_expires': {'$lt': datetime.now()}}, None),
+        ('finished mix of the same files', {'status': Status.SUCCEED.value, 'input_hashes': ['']}, None),
+    ]
 
     def __init__(self):
         super().__init__()
 
-    async def add_mix(self, task_string: str) -> ObjectId:
+    async def add_mix(self, task_string: str, file_pathes: List[str],
+                      input_hashes: Optional[List[str]] = None) -> ObjectId:
         obj_id = ObjectId()
         await self._insert_one({
             '_id': obj_id,
             'task_string': task_string,
-            'status': Status.PROCESSING.value,
+            'file_pathes': file_pathes,
+            'input_hashes': input_hashes,
+            'status': Status.QUEUED.value,
+            'attempts': 0,
             'timestamp_started': datetime.now(tz=timezone.utc),
         })
         return obj_id
 
+    async def add_reused_mix(self, task_string: str, file_pathes: List[str], input_hashes: List[str],
+                             output_file: str) -> ObjectId:
+        """Records a request which was served by the output of an earlier mix of the same files."""
+        obj_id = ObjectId()
+        now = datetime.now(tz=timezone.utc)
+        await self._insert_one({
+            '_id': obj_id,
+            'task_string': task_string,
+            'file_pathes': file_pathes,
+            'input_hashes': input_hashes,
+            'status': Status.SUCCEED.value,
+            'status_details': 'Reused an earlier mix of the same files',
+            'output_file': output_file,
+            'timestamp_started': now,
+            'timestamp_finished': now,
+        })
+        return obj_id
+
+    async def find_finished_mix(self, input_hashes: List[str]) -> Optional[VideoMix]:
+        mix = await self._find_one({'status': Status.SUCCEED.value, 'input_hashes': input_hashes},
+                                   sort=[('timestamp_finished', DESCENDING)])
+        return _get_video_mix_from_dict(mix) if mix else None
+
     async def get_mix(self, obj_id: str) -> VideoMix:
         mix = await self._find_one({'_id': ObjectId(obj_id)})
         return _get_video_mix_from_dict(mix)
 
-    async def get_all_mixes(self) -> List[VideoMix]:
-        mixes = await self._find({}).sort('timestamp_started', -1).to_list(length=1000)
-        return [_get_video_mix_from_dict(mix) for mix in mixes]
+    async def get_mixes_page(self, after: Optional[PageCursor],
+                             limit: int) -> Tuple[List[VideoMixListItem], Optional[PageCursor]]:
+        """Returns up to `limit` mixes, newest first, started before `after`, and the cursor of the next page
+        if there is one."""
+        query = {}
+        if after:
+            timestamp, obj_id = after
+            query = {'$or': [
+                {'timestamp_started': {'$lt': timestamp}},
+                {'timestamp_started': timestamp, '_id': {'$lt': obj_id}},
+            ]}
+        mixes = await self._find(query, {'task_string': 1, 'status': 1, 'output_file': 1, 'timestamp_started': 1}) \
+            .sort([('timestamp_started', DESCENDING), ('_id', DESCENDING)]) \
+            .limit(limit + 1) \
+            .to_list(length=limit + 1)
+        items = [_get_video_mix_list_item_from_dict(mix) for mix in mixes[:limit]]
+        next_cursor = (items[-1].timestamp_started, items[-1].id) if len(mixes) > limit else None
+        return items, next_cursor
+
+    async def get_summary(self) -> Dict[str, int]:
+        """Number of mixes overall and in the queue. Costs the same however many mixes there are."""
+        return {
+            'total': await self._estimated_document_count(),
+            Status.QUEUED.value: await self._count_documents({'status': Status.QUEUED.value}),
+            Status.PROCESSING.value: await self._count_documents({'status': Status.PROCESSING.value}),
+        }
+
+    async def claim_next_mix(self, worker_id: str, lease_seconds: float) -> Optional[VideoMix]:
+        mix = await self._find_one_and_update({'status': Status.QUEUED.value}, {
+            '$set': {
+                'status': Status.PROCESSING.value,
+                'lease_owner': worker_id,
+                'lease_expires': datetime.now(tz=timezone.utc) + timedelta(seconds=lease_seconds),
+            },
+            '$inc': {'attempts': 1},
+            '$unset': {'progress': ''},
+        }, sort=[('timestamp_started', ASCENDING)], return_document=ReturnDocument.AFTER)
+        return _get_video_mix_from_dict(mix) if mix else None
+
+    async def renew_lease(self, obj_id: ObjectId, worker_id: str, lease_seconds: float) -> Optional[Dict]:
+        """Extends the lease of a mix which is being rendered. Returns None if the worker doesn't own it anymore,
+        otherwise a dict telling whether cancellation was requested."""
+        return await self._find_one_and_update({
+            '_id': obj_id,
+            'status': Status.PROCESSING.value,
+            'lease_owner': worker_id,
+        }, {
+            '$set': {'lease_expires': datetime.now(tz=timezone.utc) + timedelta(seconds=lease_seconds)},
+        }, projection={'cancel_requested': 1})
+
+    async def update_progress(self, obj_id: ObjectId, frames_done: int, frames_total: int,
+                              eta_seconds: Optional[float]) -> None:
+        await self._update_one({'_id': obj_id, 'status': Status.PROCESSING.value}, {
+            '$set': {'progress': {
+                'frames_done': frames_done,
+                'frames_total': frames_total,
+                'eta_seconds': eta_seconds,
+            }}
+        })
+
+    async def get_status(self, obj_id: str) -> Optional[Dict]:
+        """Status of the mix as a JSON-serializable dict, without reading the rest of the document."""
+        mix = await self._find_one({'_id': ObjectId(obj_id)},
+                                   {'status': 1, 'status_details': 1, 'output_file': 1, 'progress': 1})
+        if not mix:
+            return None
+        return {
+            'status': mix['status'],
+            'status_details': mix.get('status_details'),
+            'output_file': mix.get('output_file'),
+            'progress': mix.get('progress'),
+        }
+
+    async def recover_orphaned_mixes(self, max_attempts: int) -> int:
+        """Puts mixes whose worker died back into the queue, or fails them if they were retried too often."""
+        now = datetime.now(tz=timezone.utc)
+        orphaned = {
+            'status': Status.PROCESSING.value,
+            '$or': [{'lease_expires': {'$lt': now}}, {'lease_expires': {'$exists': False}}],
+        }
+        failed = await self._update_many({
+            **orphaned,
+            '$and': [{'$or': [
+                {'attempts': {'$gte': max_attempts}},
+                {'file_pathes': {'$exists': False}},
+                {'cancel_requested': True},
+            ]}],
+        }, {
+            '$set': {
+                'status': Status.FAILED.value,
+                'status_details': 'Rendering was interrupted',
+                'timestamp_finished': now,
+            },
+            '$unset': {'lease_owner': '', 'lease_expires': ''},
+        })
+        requeued = await self._update_many(orphaned, {
+            '$set': {'status': Status.QUEUED.value},
+            '$unset': {'lease_owner': '', 'lease_expires': '', 'progress': ''},
+        })
+        return failed.modified_count + requeued.modified_count
+
+    async def request_cancel(self, obj_id: str) -> None:
+        await self._update_one({'_id': ObjectId(obj_id), 'status': Status.QUEUED.value}, {
+            '$set': {
+                'status': Status.CANCELLED.value,
+                'timestamp_finished': datetime.now(tz=timezone.utc),
+            }
+        })
+        await self._update_one({'_id': ObjectId(obj_id), 'status': Status.PROCESSING.value}, {
+            '$set': {'cancel_requested': True}
+        })
 
     async def mark_mix_as_succeed(self, obj_id: ObjectId, output_file: str):
         await self._update_one({'_id': obj_id}, {
@@ -55,7 +231,8 @@ class VideoMixController(BaseMongoRepository):
                 'status': Status.SUCCEED.value,
                 'output_file': output_file,
                 'timestamp_finished': datetime.now(tz=timezone.utc),
-            }
+            },
+            '$unset': {'lease_owner': '', 'lease_expires': ''},
         })
 
     async def mark_mix_as_failed(self, obj_id: ObjectId, status_details: str):
@@ -64,7 +241,17 @@ class VideoMixController(BaseMongoRepository):
                 'status': Status.FAILED.value,
                 'status_details': status_details,
                 'timestamp_finished': datetime.now(tz=timezone.utc),
-            }
+            },
+            '$unset': {'lease_owner': '', 'lease_expires': ''},
+        })
+
+    async def mark_mix_as_cancelled(self, obj_id: ObjectId):
+        await self._update_one({'_id': obj_id}, {
+            '$set': {
+                'status': Status.CANCELLED.value,
+                'timestamp_finished': datetime.now(tz=timezone.utc),
+            },
+            '$unset': {'lease_owner': '', 'lease_expires': ''},
         })
 
 
@@ -77,4 +264,17 @@ def _get_video_mix_from_dict(d: Dict) -> VideoMix:
         output_file=d.get('output_file'),
         timestamp_started=d['timestamp_started'],
         timestamp_finished=d.get('timestamp_finished'),
+        file_pathes=d.get('file_pathes', []),
+        input_hashes=d.get('input_hashes'),
+        progress=RenderProgress(**d['progress']) if d.get('progress') else None,
+    )
+
+
+def _get_video_mix_list_item_from_dict(d: Dict) -> VideoMixListItem:
+    return VideoMixListItem(
+        id=d['_id'],
+        task_string=d['task_string'],
+        status=Status(d['status']),
+        output_file=d.get('output_file'),
+        timestamp_started=d['timestamp_started'],
     )
@@ -0,0 +1,243 @@
+import logging
+import os
+import tempfile
+from fractions import Fraction
+from typing import Callable, Dict, List, Optional, Tuple
+
+import ffmpeg
+import proglog
+from moviepy.editor import (
+    concatenate_videoclips, VideoFileClip, AudioFileClip, concatenate_audioclips, ColorClip, CompositeVideoClip
+)
+
+from mezzanine_cache import MezzanineCache, file_sha256
+
+logger = logging.getLogger(__name__)
+
+# called with (frames done, frames total) while a mix is rendered
+ProgressCallback = Callable[[int, int], None]
+
+# codecs which can be copied into an .mp4 container as is
+STREAM_COPY_VIDEO_CODECS = ('h264', 'hevc')
+STREAM_COPY_AUDIO_CODECS = ('aac',)
+# stream parameters which have to match for the concat demuxer to produce a valid file, extradata_hash covers
+# the SPS/PPS of H.264 and the AudioSpecificConfig of AAC, which the copied stream keeps only from the first file
+VIDEO_SIGNATURE_KEYS = ('codec_name', 'profile', 'level', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base',
+                        'extradata_hash')
+AUDIO_SIGNATURE_KEYS = ('codec_name', 'profile', 'sample_rate', 'channels', 'channel_layout', 'extradata_hash')
+# bump when the mezzanine encoding changes, so files in the old format are not mixed with new ones
+MEZZANINE_VERSION = 'v1'
+MEZZANINE_FPS = 30
+# moves the moov atom to the front of the file, so players can start before the whole mix is downloaded
+FASTSTART = ['-movflags', '+faststart']
+
+
+def _get_rotation(stream: Dict) -> int:
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(side_data['rotation'])
+    return int(stream.get('tags', {}).get('rotate', 0))
+
+
+def probe(video_file: str) -> Dict:
+    """ffprobe output of the file, with a hash of the extradata of every stream."""
+    return ffmpeg.probe(video_file, show_data_hash='SHA256')
+
+
+def _video_stream(probe_result: Dict) -> Dict:
+    return next(s for s in probe_result['streams'] if s['codec_type'] == 'video')
+
+
+def stream_signature(probe_result: Dict) -> Optional[Tuple]:
+    """Returns what has to be equal between files to concatenate them without re-encoding, or None if the file
+    can't be stream-copied at all."""
+    streams = probe_result['streams']
+    video = [s for s in streams if s['codec_type'] == 'video']
+    audio = [s for s in streams if s['codec_type'] == 'audio']
+    if len(video) != 1 or len(audio) != 1:
+        return None
+    video, audio = video[0], audio[0]
+    if video['codec_name'] not in STREAM_COPY_VIDEO_CODECS or audio['codec_name'] not in STREAM_COPY_AUDIO_CODECS:
+        return None
+    return (
+        tuple(video.get(key) for key in VIDEO_SIGNATURE_KEYS),
+        _get_rotation(video),
+        tuple(audio.get(key) for key in AUDIO_SIGNATURE_KEYS),
+    )
+
+
+def can_stream_copy(probe_results: List[Dict]) -> bool:
+    signatures = {stream_signature(probe_result) for probe_result in probe_results}
+    return None not in signatures and len(signatures) == 1
+
+
+def get_frame_rate(probe_result: Dict) -> Fraction:
+    return Fraction(_video_stream(probe_result)['r_frame_rate'])
+
+
+def count_frames(probe_result: Dict, fps: Fraction) -> int:
+    return int(float(probe_result['format']['duration']) * fps)
+
+
+def _run_ffmpeg(stream, fps: Fraction, progress: Optional[ProgressCallback] = None, frames_before: int = 0,
+                frames_total: int = 0) -> None:
+    """Runs ffmpeg, reporting frames written so far plus `frames_before` through `progress`."""
+    process = stream \
+        .global_args('-loglevel', 'error', '-nostats', '-progress', 'pipe:1') \
+        .overwrite_output() \
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    for line in process.stdout:
+        # there is no frame count when streams are copied, so frames are derived from the output time
+        key, _, value = line.decode().strip().partition('=')
+        if key == 'out_time_us' and value.isdigit() and progress is not None:
+            progress(min(frames_before + int(int(value) * fps / 1000000), frames_total), frames_total)
+    # with -loglevel error stderr is small enough not to block ffmpeg while stdout is read
+    stderr = process.stderr.read()
+    if process.wait():
+        raise ffmpeg.Error('ffmpeg', None, stderr)
+
+
+class _MoviepyProgressLogger(proglog.ProgressBarLogger):
+    def __init__(self, progress: ProgressCallback):
+        super().__init__()
+        self._progress = progress
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        # moviepy iterates over frame times in the 't' bar, audio is written in 'chunk's before it
+        if bar == 't' and attr == 'index':
+            self._progress(value, self.bars[bar]['total'])
+
+
+def _quote_concat_path(path: str) -> str:
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+
+def concat_stream_copy(video_files: List[str], output_file: str, fps: Fraction,
+                       progress: Optional[ProgressCallback] = None, frames_total: int = 0) -> None:
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as list_file:
+        for video_file in video_files:
+            list_file.write(f'file {_quote_concat_path(video_file)}\n')
+    try:
+        stream = ffmpeg \
+            .input(list_file.name, format='concat', safe=0) \
+            .output(output_file, c='copy', movflags='+faststart')
+        _run_ffmpeg(stream, fps, progress, frames_total=frames_total)
+    finally:
+        os.remove(list_file.name)
+
+
+def get_display_size(probe_result: Dict) -> Tuple[int, int]:
+    video = _video_stream(probe_result)
+    width, height = int(video['width']), int(video['height'])
+    if _get_rotation(video) % 180:
+        width, height = height, width
+    # yuv420p needs even dimensions
+    return width - width % 2, height - height % 2
+
+
+def transcode_mezzanine(video_file: str, probe_result: Dict, output_file: str, width: int, height: int,
+                        progress: Optional[ProgressCallback] = None, frames_before: int = 0,
+                        frames_total: int = 0) -> None:
+    """Scales and center-crops the clip to fill width x height, like the moviepy renderer does, and encodes it
+    with fixed parameters so that any two mezzanines can be concatenated by stream copy."""
+    has_audio = any(s['codec_type'] == 'audio' for s in probe_result['streams'])
+    source = ffmpeg.input(video_file)
+    video = source.video \
+        .filter('scale', width, height, force_original_aspect_ratio='increase') \
+        .filter('crop', width, height) \
+        .filter('setsar', 1) \
+        .filter('fps', fps=MEZZANINE_FPS)
+    if has_audio:
+        audio = source.audio
+    else:
+        audio = ffmpeg.input('anullsrc=channel_layout=stereo:sample_rate=48000', format='lavfi').audio
+    stream = ffmpeg.output(video, audio, output_file, vcodec='libx264', preset='veryfast', crf=20, pix_fmt='yuv420p',
+                           acodec='aac', ar=48000, ac=2, video_track_timescale=90000, shortest=None,
+                           **{'profile:v': 'high'})
+    _run_ffmpeg(stream, Fraction(MEZZANINE_FPS), progress, frames_before, frames_total)
+
+
+def get_mezzanines(video_files: List[str], probe_results: List[Dict], cache: MezzanineCache,
+                   source_hashes: Optional[List[str]] = None,
+                   progress: Optional[ProgressCallback] = None) -> List[str]:
+    """Progress counts frames of all clips, cached ones are done right away."""
+    width, height = get_display_size(probe_results[0])
+    if source_hashes is None:
+        source_hashes = [file_sha256(video_file) for video_file in video_files]
+    frames = [count_frames(probe_result, MEZZANINE_FPS) for probe_result in probe_results]
+    frames_total = sum(frames)
+    mezzanines = []
+    for i, (video_file, probe_result, source_hash) in enumerate(zip(video_files, probe_results, source_hashes)):
+        frames_before = sum(frames[:i])
+        mezzanines.append(cache.get(
+            f'{source_hash}_{width}x{height}_{MEZZANINE_VERSION}', '.mp4',
+            lambda path: transcode_mezzanine(video_file, probe_result, path, width, height, progress, frames_before,
+                                             frames_total)
+        ))
+        if progress is not None:
+            progress(frames_before + frames[i], frames_total)
+    return mezzanines
+
+
+def generate_video_mix(video_files, output_file, cache: Optional[MezzanineCache] = None,
+                       source_hashes: Optional[List[str]] = None, progress: Optional[ProgressCallback] = None):
+    # every file is probed once, both ffmpeg paths work from these results
+    try:
+        probe_results = [probe(video_file) for video_file in video_files]
+    except ffmpeg.Error as e:
+        logger.warning('Failed to probe %s, re-encoding: %s', video_files, e.stderr)
+        probe_results = None
+    if probe_results is not None and can_stream_copy(probe_results):
+        try:
+            fps = get_frame_rate(probe_results[0])
+            frames_total = sum(count_frames(probe_result, fps) for probe_result in probe_results)
+            concat_stream_copy(video_files, output_file, fps, progress, frames_total)
+            logger.info('Concatenated %d files into %s without re-encoding', len(video_files), output_file)
+            return
+        except ffmpeg.Error as e:
+            logger.warning('Stream copy of %s failed, re-encoding: %s', video_files, e.stderr)
+    if probe_results is not None and cache is not None:
+        try:
+            mezzanines = get_mezzanines(video_files, probe_results, cache, source_hashes, progress)
+            concat_stream_copy(mezzanines, output_file, Fraction(MEZZANINE_FPS))
+            logger.info('Concatenated mezzanines of %d files into %s', len(video_files), output_file)
+            return
+        except ffmpeg.Error as e:
+            logger.warning('Mixing mezzanines of %s failed, re-encoding: %s', video_files, e.stderr)
+    generate_video_mix_reencode(video_files, output_file, progress)
+
+
+def generate_video_mix_reencode(video_files, output_file, progress: Optional[ProgressCallback] = None):
+    video_clips = []
+    audio_clips = []
+    first_video = VideoFileClip(video_files[0])
+    width, height = first_video.size
+
+    for video_file in video_files:
+        if os.path.exists(video_file):
+            clip = VideoFileClip(video_file)
+
+            # Resize video maintaining aspect ratio
+            if clip.aspect_ratio >= first_video.aspect_ratio:
+                clip_resized = clip.resize(width=None, height=height)
+            else:
+                clip_resized = clip.resize(width=width, height=None)
+
+            background = ColorClip((width, height), color=(0, 0, 0), duration=clip_resized.duration)
+            clip_padded = CompositeVideoClip([background, clip_resized.set_position(("center", "center"))])
+
+            video_clips.append(clip_padded)
+            audio_clips.append(AudioFileClip(video_file))
+        else:
+            print(f"File {video_file} not found. Skipping...")
+
+    # Concatenate video and audio clips separately
+    final_video = concatenate_videoclips(video_clips)
+    final_audio = concatenate_audioclips(audio_clips)
+
+    # Set the final audio to the video
+    final_clip = final_video.set_audio(final_audio)
+
+    # Write the output file
+    final_clip.write_videofile(output_file, codec='libx264', audio_codec='aac', ffmpeg_params=FASTSTART,
+                               logger=_MoviepyProgressLogger(progress) if progress else 'bar')
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import List
 
-from crypto import Crypto
+from crypto import get_crypto
 from mongo import BaseMongoRepository
 from solders.pubkey import Pubkey
 from solders.keypair import Keypair
@@ -28,7 +28,7 @@ class WalletController(BaseMongoRepository):
 
     def __init__(self):
         super().__init__()
-        self.crypto = Crypto()
+        self.crypto = get_crypto()
 
     async def mark_wallet_as_paid(self, user_id: str):
         user_id = str(user_id)
@@ -1,23 +1,35 @@
 import asyncio
 import hashlib
 import json
+import logging
 import os
-import random
 import re
-import string
-import traceback
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
 
 from concurrent.futures import ThreadPoolExecutor
 from tornado.ioloop import IOLoop
 
+from bson import ObjectId
+from bson.errors import InvalidId
+from solders.pubkey import Pubkey
 import tornado.web
 import tornado_http_auth
+from tornado.httputil import _parse_header
+from tornado.iostream import StreamClosedError
 
-from crypto import Crypto
+from airdrop_dispatcher import AirdropDispatcher
+from claim_reconciler import ClaimReconciler
+from crypto import get_crypto
 import settings
-from drop_user_controller import DropUserController
+from drop_user_controller import ClaimConflictError, DropUserController
 from mongo import MongoConnection
-from video_mix_controller import VideoMixController
+from multipart_stream import MultipartError, MultipartStreamParser
+from snapshot_index import SnapshotIndex
+from upload_controller import UploadController
+from video_mix_controller import PageCursor, Status, VideoMixController
+from video_jobs import VideoMixWorker
 import functools
 
 credentials = {settings.WEB_USERNAME: settings.WEB_PASS}
@@ -72,40 +84,130 @@ class VideoMixHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMi
             task_string = ""
             status_details = ""
         await self.render("templates/video_mix.html",
+                          video_mix_id=video_mix_id,
                           task_string=task_string,
                           status_details=status_details)
 
 
+class VideoMixStatusHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
+    """
+    Status and render progress of one mix as JSON. Clients accepting text/event-stream instead get server-sent
+    events with every change until the mix is finished.
+    """
+    poll_interval = 1
+
+    def initialize(self):
+        self._closed = False
+
+    def on_connection_close(self):
+        self._closed = True
+
+    @auth_required
+    async def get(self, video_mix_id):
+        status = await video_mix_controller.get_status(video_mix_id)
+        if status is None:
+            raise tornado.web.HTTPError(status_code=404)
+        if 'text/event-stream' not in self.request.headers.get('Accept', ''):
+            self.write(status)
+            return
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        sent = None
+        while not self._closed:
+            if status != sent:
+                self.write(f'data: {json.dumps(status)}\n\n')
+                try:
+                    await self.flush()
+                except StreamClosedError:
+                    return
+                sent = status
+            if Status(status['status']) not in (Status.QUEUED, Status.PROCESSING):
+                break
+            await asyncio.sleep(self.poll_interval)
+            status = await video_mix_controller.get_status(video_mix_id)
+            if status is None:
+                # deleted while streaming
+                self.write('event: deleted\ndata: {}\n\n')
+                break
+        if not self._closed:
+            self.finish()
+
+
+@tornado.web.stream_request_body
 class UploadHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
+    def initialize(self):
+        self._parser: Optional[MultipartStreamParser] = None
+        self._error: Optional[str] = None
+
     @auth_required
-    def post(self):
+    def prepare(self):
+        content_length = int(self.request.headers.get('Content-Length', 0))
+        if content_length > settings.UPLOAD_MAX_SIZE:
+            raise tornado.web.HTTPError(status_code=413, reason="File is too big")
+        self.request.connection.set_max_body_size(settings.UPLOAD_MAX_SIZE)
+        content_type, params = _parse_header(self.request.headers.get('Content-Type', ''))
+        if content_type != 'multipart/form-data' or 'boundary' not in params:
+            raise tornado.web.HTTPError(status_code=400, reason="Expected a multipart/form-data request")
+        self._parser = MultipartStreamParser(params['boundary'].encode(), UPLOAD)
+
+    def data_received(self, chunk):
+        if self._parser is None or self._error:
+            return
+        try:
+            self._parser.feed(chunk)
+        except MultipartError as e:
+            # the rest of the body is still read, but not parsed anymore
+            self._error = str(e)
+            self._parser.discard()
+
+    async def post(self):
+        if self._error:
+            raise tornado.web.HTTPError(status_code=400, reason=self._error)
+        if not self._parser.finished:
+            raise tornado.web.HTTPError(status_code=400, reason="Incomplete multipart body")
         try:
-            file = self.request.files['file'][0]
+            file = self._parser.files['file']
         except KeyError:
             raise tornado.web.HTTPError(status_code=400, reason="There's no file in the request")
-        user_file_name = self.get_argument('fileName')
-        original_fname = file['filename']
-        base_name = os.path.splitext(original_fname)[0]
-        extension = os.path.splitext(original_fname)[1]
+        user_file_name = self._parser.fields.get('fileName')
+        base_name, extension = os.path.splitext(file.filename)
         if not user_file_name:
             user_file_name = base_name
-            # raise tornado.web.HTTPError(status_code=400, reason="Name must not be empty")
         if not re.search('^[a-zA-Z0-9_]+$', user_file_name):
             raise tornado.web.HTTPError(status_code=400, reason="Name can only contain english letters, numbers and underscores")
-        # fname = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(6))
-        # final_filename = fname + extension
         final_filename = user_file_name + extension
-        if os.path.exists(os.path.join(UPLOAD, final_filename)):
-            self.set_status(400)
-            self.finish("File already uploaded, just use it. It's name is " + final_filename)
-        with open(os.path.join(UPLOAD, final_filename), 'wb') as output_file:
-            output_file.write(file['body'])
-        self.finish(json.dumps({'file_id': final_filename}))
+        existing = await upload_controller.get_upload(final_filename)
+        # checked before storing the file, so that it isn't left behind when the name is taken; files uploaded
+        # before they were stored by content keep their names in UPLOAD
+        name_taken = os.path.exists(os.path.join(UPLOAD, final_filename)) or (
+            existing is not None and existing.sha256 != file.sha256)
+        if not name_taken:
+            stored_file = file.sha256 + extension.lower()
+            stored_path = os.path.join(UPLOAD_BY_HASH, stored_file)
+            stored_now = not os.path.exists(stored_path)
+            if stored_now:
+                # a concurrent upload of the same content can only replace the file with identical bytes
+                os.replace(file.path, stored_path)
+            if await upload_controller.add_upload(final_filename, file.sha256, stored_file, file.size):
+                self.finish(json.dumps({'file_id': final_filename, 'sha256': file.sha256}))
+                return
+            # a concurrent upload took the name for a different file
+            if stored_now and not await upload_controller.is_stored(file.sha256):
+                os.remove(stored_path)
+        self.set_status(400)
+        self.finish("File already uploaded, just use it. It's name is " + final_filename)
+
+    def on_finish(self):
+        if self._parser:
+            self._parser.discard()
+
+    def on_connection_close(self):
+        if self._parser:
+            self._parser.discard()
 
 
 class GenerateHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
-    executor = ThreadPoolExecutor(max_workers=4)
-
     @auth_required
     async def post(self):
         try:
@@ -116,127 +218,93 @@ class GenerateHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMi
         if len(file_names) < 2:
             raise tornado.web.HTTPError(status_code=400, reason="There must be at least 2 files")
         # extension = os.path.splitext(file_names[0])[1]
-        file_pathes = [os.path.join(UPLOAD, file_name) for file_name in file_names]
-        # generate_video_mix(file_pathes, output_path)
-
-        # Start generate_video_mix in a background thread
-        # thread = threading.Thread(target=wrap_generate_video_mix, args=(mix_request, file_pathes, output_path))
-        # thread.start()
-        self.write('''
+        uploads = await upload_controller.get_uploads(file_names)
+        file_pathes = [
+            os.path.join(UPLOAD_BY_HASH, uploads[file_name].stored_file) if file_name in uploads
+            else os.path.join(UPLOAD, file_name)
+            for file_name in file_names
+        ]
+        input_hashes = None
+        if all(file_name in uploads for file_name in file_names):
+            input_hashes = [uploads[file_name].sha256 for file_name in file_names]
+            mix = await video_mix_controller.find_finished_mix(input_hashes)
+            if mix and os.path.exists(os.path.join(DOWNLOAD, mix.output_file)):
+                await video_mix_controller.add_reused_mix(mix_request, file_pathes, input_hashes, mix.output_file)
+                self.write(f'''
+                These files were already mixed.
+                <a href="/video_mix_download/{mix.output_file}">Download</a> the result
+                ''')
+                return
+        video_mix_id = await video_mix_controller.add_mix(mix_request, file_pathes, input_hashes)
+        video_mix_worker.notify()
+        self.write(f'''
         Your request has been received.
-        Checkout out <a href="/video_mixes/">video mixes</a> url to see the result
+        Follow <a href="/video_mix/{video_mix_id}">its progress</a>
+        or checkout out <a href="/video_mixes/">video mixes</a> url to see the result
         ''')
-        IOLoop.current().add_callback(execute_and_save, mix_request, file_pathes)
 
 
-class NoVideoException(Exception):
-    pass
-
-
-class VideoMixListHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
+class VideoMixCancelHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
     @auth_required
-    async def get(self):
-        video_mixes = await video_mix_controller.get_all_mixes()
-        print(video_mixes[0])
-        await self.render("templates/video_mix_list.html", title="Video Mix List", video_mixes=video_mixes)
-
-
-async def execute_and_save(mix_request, file_pathes):
-    print('execute_and_save')
-    mix_id = await video_mix_controller.add_mix(mix_request)
-    output_name = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(6)) + '.mp4'
-    output_path = os.path.join(DOWNLOAD, output_name)
-    result = await IOLoop.current().run_in_executor(GenerateHandler.executor, wrap_generate_video_mix, file_pathes, output_path)
-    if result is None:
-        await video_mix_controller.mark_mix_as_succeed(mix_id, output_name)
-    else:
-        await video_mix_controller.mark_mix_as_failed(mix_id, str(result))
-    # await save_result_to_mongo(result)
-
-
-def wrap_generate_video_mix(video_files, output_file):
-    try:
-        print("wrap_generate_video_mix")
-        for file in video_files:
-            if not os.path.exists(file):
-                raise NoVideoException(f'File {os.path.split(file)[1]} does not exist')
-        generate_video_mix(video_files, output_file)
-    except Exception as e:
-        print(f'wrap_generate_video_mix exception: {str(e)}')
-        traceback.print_exc()
-        return e
-    else:
-        print('ok fine')
+    async def post(self, video_mix_id):
+        await video_mix_controller.request_cancel(video_mix_id)
+        self.redirect("/video_mixes/")
 
 
-from moviepy.editor import (
-    concatenate_videoclips, VideoFileClip, AudioFileClip, concatenate_audioclips, ColorClip, CompositeVideoClip
-)
-import os
+def encode_page_cursor(cursor: PageCursor) -> str:
+    timestamp, obj_id = cursor
+    # mongo returns naive datetimes in UTC and keeps them with millisecond precision
+    milliseconds = int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return f'{milliseconds}_{obj_id}'
 
-def generate_video_mix(video_files, output_file):
-    video_clips = []
-    audio_clips = []
-    first_video = VideoFileClip(video_files[0])
-    width, height = first_video.size
 
-    for video_file in video_files:
-        if os.path.exists(video_file):
-            clip = VideoFileClip(video_file)
+def decode_page_cursor(value: str) -> PageCursor:
+    milliseconds, obj_id = value.split('_')
+    return datetime.fromtimestamp(int(milliseconds) / 1000, tz=timezone.utc), ObjectId(obj_id)
 
-            # Resize video maintaining aspect ratio
-            if clip.aspect_ratio >= first_video.aspect_ratio:
-                clip_resized = clip.resize(width=None, height=height)
-            else:
-                clip_resized = clip.resize(width=width, height=None)
 
-            # Pad the video
-            pad_left = int((width - clip_resized.w) / 2)
-            pad_top = int((height - clip_resized.h) / 2)
-
-            background = ColorClip((width, height), color=(0, 0, 0), duration=clip_resized.duration)
-            clip_padded = CompositeVideoClip([background, clip_resized.set_position(("center", "center"))])
-
-            video_clips.append(clip_padded)
-            audio_clips.append(AudioFileClip(video_file))
-        else:
-            print(f"File {video_file} not found. Skipping...")
-
-    # Concatenate video and audio clips separately
-    final_video = concatenate_videoclips(video_clips)
-    final_audio = concatenate_audioclips(audio_clips)
-
-    # Set the final audio to the video
-    final_clip = final_video.set_audio(final_audio)
+class VideoMixListHandler(tornado.web.RequestHandler, tornado_http_auth.DigestAuthMixin):
+    page_size = 50
 
-    # Write the output file
-    final_clip.write_videofile(output_file, codec='libx264', audio_codec='aac')
+    @auth_required
+    async def get(self):
+        after = self.get_argument('after', None)
+        try:
+            after = decode_page_cursor(after) if after else None
+        except (ValueError, InvalidId):
+            raise tornado.web.HTTPError(status_code=400, reason="Invalid page")
+        video_mixes, next_cursor = await video_mix_controller.get_mixes_page(after, self.page_size)
+        summary = await video_mix_controller.get_summary()
+        await self.render("templates/video_mix_list.html", title="Video Mix List", video_mixes=video_mixes,
+                          summary=summary, next_page=encode_page_cursor(next_cursor) if next_cursor else None)
 
 
 class DownloadHandler(tornado.web.StaticFileHandler):
-    async def get(self, filename, include_body=True):
-        await super().get(filename, include_body)
-
-def get_user_allowance(user_id: str) -> (int, str):
-    found_in_groups = []
-    # look through all json files in folder and create a list of files where user_id is present
-    for file in os.listdir(settings.SNAPSHOTS_DIR):
-        if file.endswith(".json"):
-            with open(os.path.join(settings.SNAPSHOTS_DIR, file), 'r') as f:
-                data = json.load(f)
-                if user_id in data['users']:
-                    found_in_groups.append(data['name'])
+    """
+    Serves rendered mixes, Range requests are handled by StaticFileHandler. When a fronting server is configured,
+    the file is only looked up here and the transfer is handed over to it with X-Accel-Redirect or X-Sendfile.
+    """
 
-    details = 'ни в каких'
-    allowance_user = settings.BHUMI_DROP_BASE
+    async def get(self, filename, include_body=True):
+        if not settings.DOWNLOAD_ACCEL_REDIRECT and not settings.DOWNLOAD_X_SENDFILE:
+            await super().get(filename, include_body)
+            return
+        self.path = self.parse_url_path(filename)
+        absolute_path = self.get_absolute_path(self.root, self.path)
+        self.absolute_path = self.validate_absolute_path(self.root, absolute_path)
+        if self.absolute_path is None:
+            return
+        if settings.DOWNLOAD_ACCEL_REDIRECT:
+            location = settings.DOWNLOAD_ACCEL_REDIRECT.rstrip('/') + '/' + tornado.escape.url_escape(self.path, plus=False)
+            self.set_header('X-Accel-Redirect', location)
+        else:
+            self.set_header('X-Sendfile', self.absolute_path)
+        self.set_header('Content-Type', self.get_content_type())
+        self.finish()
 
-    if found_in_groups:
-        details = ', '.join(found_in_groups)
-        allowance_user += settings.BHUMI_DROP_BASE * len(found_in_groups)
-        if "\u0428\u043c\u0438\u044216" in found_in_groups or "Syntony" in found_in_groups:
-            allowance_user += settings.BHUMI_DROP_BASE * 2
 
-    return allowance_user, details
+def get_user_allowance(user_id: str) -> (int, str):
+    return snapshot_index.get_allowance(user_id)
 
 
 class AirdropAmountHandler(tornado.web.RequestHandler):
@@ -248,13 +316,22 @@ class AirdropAmountHandler(tornado.web.RequestHandler):
         allowance_user, details = get_user_allowance(user_id)
 
         user_obj = await drop_user_controller.get_user(user_id)
-        claimed_user = user_obj.claimed
+        # a claim in flight is counted as claimed, like reserve_claim does, so what is left to drop matches what
+        # a drop would get
+        claimed_user = user_obj.claimed + user_obj.pending
         claimed_total = await drop_user_controller.get_total_claimed()
 
-        await self.finish(json.dumps({'allowance_user': allowance_user, 'details': details, 'claimed_user': claimed_user, 'claimed_total': claimed_total}))
+        await self.finish(json.dumps({'allowance_user': allowance_user, 'details': details, 'claimed_user': claimed_user, 'pending_user': user_obj.pending, 'claimed_total': claimed_total}))
 
 
 class AirdropDropHandler(tornado.web.RequestHandler):
+    """
+    Claims what is left of the user's allowance: reserves the amount and sends it. A claim which was never
+    submitted is rolled back right away; a submitted one stays pending until `ClaimReconciler` sees its
+    transaction land or expire, so the amount is never paid twice.
+    """
+    _logger = logging.getLogger(__name__)
+
     async def get(self):
         user_id = self.get_argument('user_id')
         if not user_id:
@@ -262,49 +339,137 @@ class AirdropDropHandler(tornado.web.RequestHandler):
         wallet = self.get_argument('wallet')
         if not wallet:
             raise tornado.web.HTTPError(status_code=400, reason="No wallet provided")
+        try:
+            Pubkey.from_string(wallet)
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, reason="Invalid wallet")
         ref = self.get_argument('ref')
         if not ref:
             ref = ''
 
         allowance_user, details = get_user_allowance(user_id)
 
-        user_obj = await drop_user_controller.get_user(user_id)
-        claimed_user = user_obj.claimed
-
-        if claimed_user >= allowance_user:
+        try:
+            claim = await drop_user_controller.reserve_claim(user_id, allowance_user, wallet, ref)
+        except ClaimConflictError:
+            raise tornado.web.HTTPError(status_code=409, reason="Claim is already in progress")
+        if claim is None:
             await self.finish(json.dumps({'drop_details': 'У тебя нет BHUMI которые можно было бы получить', 'dropped_amount': 0}))
+            return
 
-        drop_amount = allowance_user - claimed_user
-
-        # drop should happen here
-        hash = await crypto.transfer_drop(wallet, drop_amount, settings.SOL_DROP_AMOUNT)
-        await drop_user_controller.add_claim(user_id, drop_amount, wallet, ref)
+        drop_amount = claim.amount
+        try:
+            sent = await airdrop_dispatcher.drop(wallet, drop_amount, settings.SOL_DROP_AMOUNT)
+        except Exception:
+            # nothing was submitted
+            await drop_user_controller.rollback_claim(claim)
+            raise
+        await drop_user_controller.set_claim_transaction(claim, sent.signature, sent.last_valid_block_height)
+        if sent.error:
+            self._logger.warning('Submitting claim %s failed, leaving it to the reconciler: %s', claim.id, sent.error)
+            raise tornado.web.HTTPError(status_code=503, reason="Drop status is unknown")
 
-        await self.finish(json.dumps({'drop_details': f'Отправил {drop_amount} BHUMI по адресу {wallet}\n\nСсылка на транзакцию: https://solscan.io/tx/{hash}', 'dropped_amount': drop_amount}))
+        await self.finish(json.dumps({'drop_details': f'Отправил {drop_amount} BHUMI по адресу {wallet}\n\nСсылка на транзакцию: https://solscan.io/tx/{sent.signature}', 'dropped_amount': drop_amount}))
 
 
 from io import BytesIO
 import qrcode
+import qrcode.image.svg
+
+QR_ERROR_LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+QR_CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def render_qr_code(data: str, box_size: int, border: int, error_level: str, image_format: str) -> bytes:
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=QR_ERROR_LEVELS[error_level],
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img_buffer = BytesIO()
+    if image_format == 'svg':
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+        img.save(img_buffer)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(img_buffer, "PNG")
+    return img_buffer.getvalue()
+
+
+class QRCodeCache:
+    """LRU cache of rendered QR codes, bounded by the total size of the images."""
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._images: OrderedDict = OrderedDict()
+
+    def get(self, key) -> Optional[bytes]:
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+        return image
+
+    def put(self, key, image: bytes) -> None:
+        if key in self._images:
+            return
+        self._images[key] = image
+        self._bytes += len(image)
+        while self._bytes > self._max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self._bytes -= len(evicted)
+
 
 class QRCodeHandler(tornado.web.RequestHandler):
+    executor = ThreadPoolExecutor(max_workers=2)
+    cache = QRCodeCache(max_bytes=settings.QR_CACHE_BYTES)
+
+    def _get_int_argument(self, name: str, default: int, min_value: int, max_value: int) -> int:
+        try:
+            value = int(self.get_argument(name, str(default)))
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, reason=f"{name} must be a number")
+        return min(max(value, min_value), max_value)
+
     async def get(self):
         data = self.get_argument('data', 'Hello, Tornado!')
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
+        box_size = self._get_int_argument('size', 10, 1, 40)
+        border = self._get_int_argument('border', 4, 0, 16)
+        error_level = self.get_argument('ec', 'L').upper()
+        if error_level not in QR_ERROR_LEVELS:
+            raise tornado.web.HTTPError(status_code=400, reason="ec must be one of L, M, Q, H")
+        image_format = self.get_argument('format', 'png').lower()
+        if image_format not in QR_CONTENT_TYPES:
+            raise tornado.web.HTTPError(status_code=400, reason="format must be png or svg")
+
+        # the image is fully defined by the parameters, so the etag is known before rendering
+        key = (data, box_size, border, error_level, image_format)
+        self.set_header("ETag", '"%s"' % hashlib.sha1(json.dumps(key).encode()).hexdigest())
+        self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        image = self.cache.get(key)
+        if image is None:
+            image = await IOLoop.current().run_in_executor(self.executor, render_qr_code, *key)
+            self.cache.put(key, image)
+        self.set_header("Content-Type", QR_CONTENT_TYPES[image_format])
+        self.set_header("Content-Length", len(image))
+        self.write(image)
 
-        img = qr.make_image(fill_color="black", back_color="white")
-        img_buffer = BytesIO()
-        img.save(img_buffer, "PNG")
-        img_buffer.seek(0)
-        self.set_header("Content-Type", "image/png")
-        self.set_header("Content-Length", img_buffer.getbuffer().nbytes)
-        self.write(img_buffer.getvalue())
 
 def make_app():
 
@@ -312,6 +477,8 @@ def make_app():
         (r"/test/", TestHandler),
         (r"/auth/", AuthHandler),
         (r"/video_mix/([a-zA-Z0-9]*/?)", VideoMixHandler),
+        (r"/video_mix/([a-f0-9]{24})/cancel", VideoMixCancelHandler),
+        (r"/video_mix/([a-f0-9]{24})/status", VideoMixStatusHandler),
         (r"/video_mix_download/(.*)", DownloadHandler, {"path": DOWNLOAD}),
         (r"/video_mixes/", VideoMixListHandler),
         (r"/upload", UploadHandler),
@@ -326,14 +493,22 @@ async def main_tornado():
     app = make_app()
     app.listen(8432)
     app.settings["cookie_secret"] = hashlib.sha256(settings.COOKIE_SECRET.encode()).hexdigest()
+    await video_mix_worker.start()
+    claim_reconciler.start()
     await asyncio.Event().wait()
 
 
 UPLOAD = os.path.join(settings.VIDEO_ROOT, 'upload')
+UPLOAD_BY_HASH = os.path.join(UPLOAD, 'sha256')
 DOWNLOAD = os.path.join(settings.VIDEO_ROOT, 'download')
 video_mix_controller = VideoMixController()
+upload_controller = UploadController()
+video_mix_worker = VideoMixWorker(video_mix_controller, DOWNLOAD)
 drop_user_controller = DropUserController()
-crypto = Crypto()
+snapshot_index = SnapshotIndex()
+crypto = get_crypto()
+airdrop_dispatcher = AirdropDispatcher(crypto)
+claim_reconciler = ClaimReconciler(drop_user_controller, crypto)
 
 def init_web():
     # client = AsyncIOMotorClient()
@@ -344,6 +519,8 @@ def init_web():
         os.mkdir(settings.VIDEO_ROOT)
     if not os.path.exists(UPLOAD):
         os.mkdir(UPLOAD)
+    if not os.path.exists(UPLOAD_BY_HASH):
+        os.mkdir(UPLOAD_BY_HASH)
     if not os.path.exists(DOWNLOAD):
         os.mkdir(DOWNLOAD)
 
@@ -351,6 +528,7 @@ def init_web():
 async def async_init():
     MongoConnection.initialize()
     await VideoMixController.initialize()
+    await UploadController.initialize()
     await DropUserController.initialize()
 
 